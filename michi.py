@@ -13,7 +13,7 @@
 #
 # To start reading the code, begin either:
 # * Bottom up, by looking at the goban implementation - starting with
-#   the 'empty' definition below and Position.move() method.
+#   the Geometry class below and Position.move() method.
 # * In the middle, by looking at the Monte Carlo playout implementation,
 #   starting with the mcplayout() function.
 # * Top down, by looking at the MCTS implementation, starting with the
@@ -24,32 +24,56 @@
 # from start to end.
 
 
-from collections import namedtuple
+from array import array
+from collections import OrderedDict
 from itertools import count
 import math
+import mmap
 import multiprocessing
+import os
+import queue
 from multiprocessing.pool import Pool
+from multiprocessing.sharedctypes import RawArray, RawValue
 import random
 import re
+import struct
 import sys
+import threading
 import time
 from functools import reduce
+import json
+try:
+    import numpy as np  # optional, tree statistics are kept in plain lists without it
+except ImportError:
+    np = None
+try:
+    import resource  # optional, for the peak memory usage in benchmark results
+except ImportError:
+    resource = None
+try:
+    import fcntl  # optional, for locking the position book against other processes updating it
+except ImportError:
+    fcntl = None
 
 
 # Given a board of size NxN (N=9, 19, ...), we represent the position
-# as an (N+1)*(N+2) string, with '.' (empty), 'X' (to-play player),
-# 'x' (other player), and whitespace (off-board border to make rules
-# implementation easier).  Coordinates are just indices in this string.
-# You can simply print(board) when debugging.
-N = 13
-W = N + 2
-empty = "\n".join([(N+1)*' '] + N*[' '+N*'.'] + [(N+2)*' '])
+# as a W*W bytearray (W=N+2) of colors EMPTY, BLACK, WHITE and OUT
+# (off-board border to make rules implementation easier).  Colors are
+# absolute, the player to play is given by the move number parity.
+# Coordinates are just indices in this array.  You can simply
+# print(board_str(board)) when debugging.  W, the empty board and the
+# other tables derived from the board size are set by set_board_size().
+N = 13  # default board size; GTP boardsize can switch it
+EMPTY, BLACK, WHITE, OUT = range(4)
 colstr = 'ABCDEFGHJKLMNOPQRST'
-MAX_GAME_LEN = N * N * 3
 
 N_SIMS = 1400
 RAVE_EQUIV = 3500
 EXPAND_VISITS = 8
+LAZY_EXPAND = True  # expand game tree nodes lazily, with progressive widening (see TreeNode.expand())
+LAZY_EXPAND_VISITS = 4  # EXPAND_VISITS with LAZY_EXPAND, expansion being much cheaper then
+WIDENING_BASE = 10  # number of children open to selection in a lazily expanded node...
+WIDENING_RATE = 1.0  # ...plus this times the square root of the node visits
 PRIOR_EVEN = 10  # should be even number; 0.5 prior
 PRIOR_SELFATARI = 10  # negative prior
 PRIOR_CAPTURE_ONE = 15
@@ -65,6 +89,26 @@ PROB_RSAREJECT = 0.5  # probability of rejecting random self-atari in playout; t
 RESIGN_THRES = 0.2
 FASTPLAY20_THRES = 0.8  # if at 20% playouts winrate is >this, stop reading
 FASTPLAY5_THRES = 0.95  # if at 5% playouts winrate is >this, stop reading
+TT_SIZE = 200000  # max. number of tree nodes shared through the transposition table; 0 to disable
+SEARCH_MODE = 'pool'  # 'pool' to run playouts in a process pool, 'shared' for tree-parallel search on a tree in shared memory
+PLAYOUT_BATCH = 4  # number of playouts sent to a pool worker at once
+PLAYOUT_ENGINE = 'python'  # 'python' for mcplayout(), 'numpy' for batch_playouts() in the pool workers (needs NumPy)
+NUMPY_PLAYOUT_BATCH = 128  # number of playouts sent to a pool worker at once with the 'numpy' engine
+SHARED_TREE_SIZE = 1000000  # max. number of nodes of the shared memory tree
+SHARED_IMPORT_DEPTH = 2  # depth up to which nodes expanded in the shared memory tree are copied to the game tree
+TIME_MOVES_LEFT_MIN = 20  # main time is spread over at least this many of our moves
+TIME_MARGIN = 0.5  # seconds per move left for communication lag
+PONDER = False  # keep searching while waiting for the next GTP command (also enabled by 'gtp ponder')
+PROFILE = False  # collect time spent in the search phases, reported after each genmove (also enabled by 'gtp profile')
+PATTERN_HASH_SEED = 0x7370617469616c  # seed of the large pattern hash keys
+LADDER_MEMO_SIZE = 100000  # max. number of memoized ladder reading results
+MAX_TREE_MEMORY = 256 << 20  # max. estimated bytes of the game tree kept between moves (see node_memory()); subtrees of the least visited nodes are pruned
+BOOK = False  # keep the search results of opening positions across games in book_file (also enabled by 'gtp book')
+BOOK_MOVES = 20  # positions before this move number are kept in the position book
+BOOK_ENTRY_MOVES = 8  # number of the most visited moves of a position kept in the position book
+BOOK_SLOTS = 1 << 18  # number of entries of a new position book file, at most half of them get used
+BOOK_PRIOR_VISITS = 50  # max. number of prior visits of a move taken from the position book
+BOOK_INSTANT_VISITS = 5000  # genmove plays a book move with this many visits without searching
 
 pat3src = [  # 3x3 playout patterns; X,O are colors, x,o are their inverses
        ["XOX",  # hane pattern - enclosing hane
@@ -129,72 +173,163 @@ pat_gridcular_seq = [  # Sequence of coordinate offsets of progressively wider d
     ]
 spat_patterndict_file = 'patterns.spat'
 large_patterns_file = 'patterns.prob'
+patterns_db_file = 'patterns.db'  # compiled from the two above by 'michi.py compile_patterns'
+book_file = 'michi.book'  # persistent position book, see PositionBook
 
 
 #######################
-# board string routines
-
-def neighbors(c):
-    """ generator of coordinates for all neighbors of c """
-    return [c-1, c+1, c-W, c+W]
-
-def diag_neighbors(c):
-    """ generator of coordinates for all diagonal neighbors of c """
-    return [c-W-1, c-W+1, c+W-1, c+W+1]
-
-
-def board_put(board, c, p):
-    return board[:c] + p + board[c+1:]
-
-
-def floodfill(board, c):
-    """ replace continuous-color area starting at c with special color # """
-    # This is called so much that a bytearray is worthwhile...
-    byteboard = bytearray(board, encoding='utf-8')
-    p = byteboard[c]
-    byteboard[c] = ord('#')
-    fringe = [c]
-    while fringe:
-        c = fringe.pop()
-        for d in neighbors(c):
-            if byteboard[d] == p:
-                byteboard[d] = ord('#')
-                fringe.append(d)
-    return str(byteboard, encoding='utf-8')
-
-
-# Regex that matches various kind of points adjecent to '#' (floodfilled) points
-contact_res = dict()
-for p in ['.', 'x', 'X']:
-    rp = '\\.' if p == '.' else p
-    contact_res_src = ['#' + rp,  # p at right
-                       rp + '#',  # p at left
-                       '#' + '.'*(W-1) + rp,  # p below
-                       rp + '.'*(W-1) + '#']  # p above
-    contact_res[p] = re.compile('|'.join(contact_res_src), flags=re.DOTALL)
-
-def contact(board, p):
-    """ test if point of color p is adjecent to color # anywhere
-    on the board; use in conjunction with floodfill for reachability """
-    m = contact_res[p].search(board)
-    if not m:
-        return None
-    return m.start() if m.group(0)[0] == p else m.end() - 1
+# board routines
+
+class Geometry():
+    """ Board of size NxN with all the tables derived from its size,
+    indexed by coordinate and precomputed for all board points (off-board
+    points have no neighbors etc.); set_board_size() makes them the module
+    globals of the same names used by the rest of the program """
+    __slots__ = ['N', 'W', 'empty', 'MAX_GAME_LEN', 'board_points', 'neighbors', 'diag_neighbors',
+                 'area3_points', 'line_height', 'neighborhood_offsets', 'neighborhood_updates',
+                 'zobrist', 'symmetries', 'inverse_symmetries', 'gridcular_table']
+
+    def __init__(self, n):
+        self.N = n
+        self.W = W = n + 2
+        self.empty = empty = bytes([EMPTY if p == '.' else OUT
+                                    for p in "\n".join([(n+1)*' '] + n*[' '+n*'.'] + [(n+2)*' '])])
+        self.MAX_GAME_LEN = n * n * 3
+        self.board_points = board_points = [c for c in range(W*W) if empty[c] == EMPTY]
+
+        # The neighbors, the diagonal neighbors, the points in Manhattan
+        # distance up to 3 (for empty_area()) and the line height (0-indexed)
+        self.neighbors = [(c-1, c+1, c-W, c+W) if empty[c] == EMPTY else () for c in range(W*W)]
+        self.diag_neighbors = [(c-W-1, c-W+1, c+W-1, c+W+1) if empty[c] == EMPTY else () for c in range(W*W)]
+        self.area3_points = [tuple(d for d in board_points if 0 < self.manhattan_distance(c, d) <= 3)
+                             if empty[c] == EMPTY else () for c in range(W*W)]
+        self.line_height = [self.point_line_height(c) if empty[c] == EMPTY else None for c in range(W*W)]
+
+        # The 3x3 neighborhood of a point is encoded as an integer with
+        # 2 bits for the color of each of the 8 points around it, in the
+        # order of the pattern strings (row by row, skipping the point
+        # itself); positions keep the codes of all points up to date as
+        # stones come and go
+        self.neighborhood_offsets = [-W-1, -W, -W+1, -1, 1, W-1, W, W+1]
+        # for each point, the (neighbor, unit) pairs such that a change of
+        # color at the point changes the code of neighbor by unit * color
+        # difference
+        self.neighborhood_updates = [[(c - off, 1 << 2*k) for k, off in enumerate(self.neighborhood_offsets)]
+                                     if empty[c] == EMPTY else [] for c in range(W*W)]
+
+        # Zobrist hashing keys for each color at each coordinate; the hash
+        # of a board is the xor of keys of all its stones.  They are drawn
+        # from a fixed seed so that hashes are the same in every process
+        # and run.
+        rng = random.Random(0x6d69636869)
+        self.zobrist = [W*W*[0]] + [[rng.getrandbits(64) for c in range(W*W)] for color in (BLACK, WHITE)]
+
+        # The 8 symmetries of the board (rotations and reflections, the
+        # identity first) as maps of coordinates, and their inverses
+        self.symmetries = []
+        for swap in (False, True):
+            for flipy in (False, True):
+                for flipx in (False, True):
+                    sym = W*W*[0]
+                    for c in board_points:
+                        y, x = divmod(c - (W+1), W)
+                        if swap:
+                            y, x = x, y
+                        if flipy:
+                            y = n-1 - y
+                        if flipx:
+                            x = n-1 - x
+                        sym[c] = (y+1)*W + x+1
+                    self.symmetries.append(sym)
+        self.inverse_symmetries = []
+        for sym in self.symmetries:
+            inverse = W*W*[0]
+            for c in board_points:
+                inverse[sym[c]] = c
+            self.inverse_symmetries.append(inverse)
+
+        # The points of the large pattern neighborhood, see
+        # large_pattern_probability()
+        self.gridcular_table = [self.gridcular_points(c) if empty[c] == EMPTY else None for c in range(W*W)]
+
+    def point_line_height(self, c):
+        """ Return the line number above nearest board edge """
+        row, col = divmod(c - (self.W+1), self.W)
+        return min(row, col, self.N-1-row, self.N-1-col)
+
+    def manhattan_distance(self, c, d):
+        (cy, cx), (dy, dx) = divmod(c, self.W), divmod(d, self.W)
+        return abs(cy - dy) + abs(cx - dx)
+
+    def gridcular_points(self, c):
+        """ list of the sequences of points forming the gridcular neighborhood
+        of c in each rotation, off-board points given as 0 (which is OUT) """
+        # Each rotations element is (xyindex, xymultiplier)
+        rotations = [((0,1),(1,1)), ((0,1),(-1,1)), ((0,1),(1,-1)), ((0,1),(-1,-1)),
+                     ((1,0),(1,1)), ((1,0),(-1,1)), ((1,0),(1,-1)), ((1,0),(-1,-1))]
+        W, N = self.W, self.N
+        y0, x0 = divmod(c - (W+1), W)
+        points = []
+        for r in rotations:
+            points.append([])
+            for dseq in pat_gridcular_seq:
+                for o in dseq:
+                    y = y0 + o[r[0][0]]*r[1][0]
+                    x = x0 + o[r[0][1]]*r[1][1]
+                    points[-1].append((y+1)*W + x+1 if y >= 0 and y < N and x >= 0 and x < N else 0)
+        return points
+
+
+geometries = dict()  # board size -> Geometry, each made just once
+
+def set_board_size(n):
+    """ switch to board size n, setting the globals derived from it to
+    those of its Geometry; positions of the previous size cannot be used
+    anymore """
+    global N, W, empty, MAX_GAME_LEN, board_points, neighbors, diag_neighbors, area3_points, line_height
+    global neighborhood_offsets, neighborhood_updates, zobrist, symmetries, inverse_symmetries, gridcular_table
+    if n not in geometries:
+        geometries[n] = Geometry(n)
+    g = geometries[n]
+    N, W, empty, MAX_GAME_LEN = g.N, g.W, g.empty, g.MAX_GAME_LEN
+    board_points, neighbors, diag_neighbors = g.board_points, g.neighbors, g.diag_neighbors
+    area3_points, line_height = g.area3_points, g.line_height
+    neighborhood_offsets, neighborhood_updates = g.neighborhood_offsets, g.neighborhood_updates
+    zobrist, gridcular_table = g.zobrist, g.gridcular_table
+    symmetries, inverse_symmetries = g.symmetries, g.inverse_symmetries
+
+set_board_size(N)
+
+
+# Translation table from board arrays to the traditional string form
+# of the board
+board_str_table = bytes.maketrans(bytes(range(4)), b'.XO ')
+
+def board_str(board):
+    """ return the board array as a string with 'X' black, 'O' white, '.'
+    (empty) and whitespace (off-board border), rows separated by newlines """
+    sboard = bytearray(board.translate(board_str_table))
+    sboard[W-1 : W*W-W : W] = (W-1) * b'\n'
+    return sboard.decode()
+
+
+def neighborhood_code(board, c):
+    """ return the 3x3 neighborhood code of point c """
+    return sum(board[c + off] << 2*k for k, off in enumerate(neighborhood_offsets))
 
 
 def is_eyeish(board, c):
     """ test if c is inside a single-color diamond and return the diamond
     color or None; this could be an eye, but also a false one """
     eyecolor = None
-    for d in neighbors(c):
-        if board[d].isspace():
+    for d in neighbors[c]:
+        if board[d] == OUT:
             continue
-        if board[d] == '.':
+        if board[d] == EMPTY:
             return None
         if eyecolor is None:
             eyecolor = board[d]
-            othercolor = eyecolor.swapcase()
-        elif board[d] == othercolor:
+        elif board[d] != eyecolor:
             return None
     return eyecolor
 
@@ -205,11 +340,11 @@ def is_eye(board, c):
         return None
 
     # Eye-like shape, but it could be a falsified eye
-    falsecolor = eyecolor.swapcase()
+    falsecolor = BLACK + WHITE - eyecolor
     false_count = 0
     at_edge = False
-    for d in diag_neighbors(c):
-        if board[d].isspace():
+    for d in diag_neighbors[c]:
+        if board[d] == OUT:
             at_edge = True
         elif board[d] == falsecolor:
             false_count += 1
@@ -221,71 +356,285 @@ def is_eye(board, c):
     return eyecolor
 
 
-class Position(namedtuple('Position', 'board cap n ko last last2 komi')):
-    """ Implementation of simple Chinese Go rules;
-    n is how many moves were played so far """
+# bits of stone colors touching a region in Position.owners()
+owner_bits = bytes([0, BLACK, WHITE, 0])
 
-    def move(self, c):
-        """ play as player X at the given coord c, return the new position """
+
+class Position():
+    """ Implementation of simple Chinese Go rules;
+    n is how many moves were played so far, hash is the Zobrist hash
+    of the stones on board and history is a set of hashes of positions
+    that occured earlier in the game (for the positional superko rule)
+
+    Besides the board array, we incrementally maintain per-group data
+    so that capture and suicide tests do not need to floodfill the board:
+    group[c] is the coordinate of the "head" stone of the group at c
+    (0 for empty points), nxt[c] links all stones of a group in a circular
+    chain and libs[head] is a frozenset of the group liberties.  nbcode[c]
+    is the 3x3 neighborhood code of point c (see neighborhood_code()),
+    empties is a list of all empty points in no particular order and
+    empty_index[c] the index of empty point c in it; all board changes go
+    through put() to keep these in sync.
+
+    Positions stored in the tree are treated as immutable and new ones are
+    created by move() and pass_move().  They are compact, keeping just the
+    board and the scalars (the per-group data etc. being None), as there
+    are many of them and they are sent to the worker processes.  Playouts
+    instead work on a private copy(), which has the per-group data built
+    anew and is modified in place by play(); every change is recorded
+    in the undo log so that undo() can take a move back, which is handy
+    to try out moves without allocating new positions. """
+    __slots__ = ['board', 'cap', 'n', 'ko', 'last', 'last2', 'komi', 'hash', 'history',
+                 'group', 'nxt', 'libs', 'nbcode', 'empties', 'empty_index', 'undo_log', 'undo_marks']
+
+    def __init__(self, board, cap, n, ko, last, last2, komi, hash, history, group=None, nxt=None, libs=None,
+                 nbcode=None, empties=None, empty_index=None):
+        self.board = board
+        self.cap = cap
+        self.n = n
+        self.ko = ko
+        self.last = last
+        self.last2 = last2
+        self.komi = komi
+        self.hash = hash
+        self.history = history
+        self.group = group
+        self.nxt = nxt
+        self.libs = libs
+        self.nbcode = nbcode
+        self.empties = empties
+        self.empty_index = empty_index
+        self.undo_log = None  # (array, index, old value) records, set up by copy()
+        self.undo_marks = None  # undo_log length and scalar state before each play()
+
+    @property
+    def color(self):
+        """ color of the player to play """
+        return BLACK if self.n % 2 == 0 else WHITE
+
+    def __reduce__(self):
+        # Pickle just the compact position
+        return (Position, (self.board, self.cap, self.n, self.ko, self.last, self.last2, self.komi,
+                           self.hash, self.history))
+
+    def copy(self):
+        """ return a copy of the position that can be modified independently
+        (and played on, having the per-group data) """
+        pos = Position(board=bytearray(self.board), cap=self.cap, n=self.n, ko=self.ko,
+                       last=self.last, last2=self.last2, komi=self.komi,
+                       hash=self.hash, history=self.history)
+        if self.group is None:
+            pos.init_groups()
+        else:
+            pos.group, pos.nxt, pos.libs = list(self.group), list(self.nxt), list(self.libs)
+            pos.nbcode, pos.empties, pos.empty_index = list(self.nbcode), list(self.empties), list(self.empty_index)
+        pos.undo_log, pos.undo_marks = [], []
+        return pos
+
+    def compact(self):
+        """ return a compact copy of the position, without the per-group data """
+        return Position(board=bytearray(self.board), cap=self.cap, n=self.n, ko=self.ko,
+                        last=self.last, last2=self.last2, komi=self.komi,
+                        hash=self.hash, history=self.history)
+
+    def init_groups(self):
+        """ build the per-group data, neighborhood codes and empty points
+        list from the board """
+        board = self.board
+        group, nxt, libs = W*W*[0], W*W*[0], W*W*[None]
+        for c in board_points:
+            if board[c] == EMPTY or group[c]:
+                continue
+            # Floodfill the group of c, which becomes its head
+            color = board[c]
+            group[c] = c
+            stones = [c]
+            liberties = set()
+            for s in stones:  # grows meanwhile
+                for d in neighbors[s]:
+                    if board[d] == color and not group[d]:
+                        group[d] = c
+                        stones.append(d)
+                    elif board[d] == EMPTY:
+                        liberties.add(d)
+            for s, t in zip(stones, stones[1:] + stones[:1]):
+                nxt[s] = t
+            libs[c] = frozenset(liberties)
+        self.group, self.nxt, self.libs = group, nxt, libs
+        self.nbcode = W*W*[0]
+        for c in board_points:
+            self.nbcode[c] = neighborhood_code(board, c)
+        self.empties = [c for c in board_points if board[c] == EMPTY]
+        self.empty_index = W*W*[0]
+        for i, c in enumerate(self.empties):
+            self.empty_index[c] = i
+
+    def key(self):
+        """ return the key identifying the position in the transposition
+        table; besides the stones, it includes the move number (so that
+        the tree stays acyclic), the ko and the last move (that the tree
+        code takes as the move leading to a node) """
+        return (self.hash, self.n, self.ko, self.last)
+
+    def liberties(self, c):
+        """ return the frozenset of liberties of the group at c """
+        return self.libs[self.group[c]]
+
+    def put(self, c, color):
+        """ set the color of board point c, updating the neighborhood codes
+        and the empty points list """
+        old = self.board[c]
+        self.board[c] = color
+        delta = color - old
+        nbcode = self.nbcode
+        for d, unit in neighborhood_updates[c]:
+            nbcode[d] += delta * unit
+        # Swap-remove a point getting a stone from the empty points list,
+        # append a point getting empty
+        empties, empty_index = self.empties, self.empty_index
+        if old == EMPTY:
+            last = empties.pop()
+            if last != c:
+                i = empty_index[c]
+                empties[i] = last
+                empty_index[last] = i
+        elif color == EMPTY:
+            empty_index[c] = len(empties)
+            empties.append(c)
+
+    def play(self, c):
+        """ play as player to-play at the given coord c (or pass if c is None)
+        in place; return False if the move is illegal, leaving the position
+        unchanged """
 
         # Test for ko
-        if c == self.ko:
-            return None
+        if c is not None and c == self.ko:
+            return False
+        color = self.color
+        other = BLACK + WHITE - color
+        undo = self.undo_log
+        self.undo_marks.append((len(undo), self.cap, self.ko, self.last, self.last2, self.hash))
+        self.n += 1
+        self.last2 = self.last
+        self.last = c
+        if c is None:
+            self.cap = (self.cap[1], self.cap[0])
+            self.ko = None
+            return True
+
+        board, group, nxt, libs = self.board, self.group, self.nxt, self.libs
         # Are we trying to play in enemy's eye?
-        in_enemy_eye = is_eyeish(self.board, c) == 'x'
+        in_enemy_eye = is_eyeish(board, c) == other
+
+        undo.append((board, c, EMPTY))
+        self.put(c, color)
+        self.hash ^= zobrist[color][c]
+        undo.append((group, c, group[c]))
+        group[c] = c
+        undo.append((nxt, c, nxt[c]))
+        nxt[c] = c
+        undo.append((libs, c, libs[c]))
+        libs[c] = frozenset([d for d in neighbors[c] if board[d] == EMPTY])
+
+        # Take away the liberty from neighboring groups, joining our own
+        # ones with the new stone
+        enemies = []
+        for d in neighbors[c]:
+            if board[d] == other:
+                g = group[d]
+                if g not in enemies:
+                    undo.append((libs, g, libs[g]))
+                    libs[g] = libs[g] - {c}
+                    enemies.append(g)
+            elif board[d] == color and group[d] != group[c]:
+                # relabel the new stone into the first group we touch, but
+                # further groups into the joined one
+                if group[c] == c:
+                    head, g = group[d], c
+                else:
+                    head, g = group[c], group[d]
+                undo.append((libs, head, libs[head]))
+                libs[head] = (libs[head] | libs[g]) - {c}
+                undo.append((libs, g, libs[g]))
+                libs[g] = None
+                s = g
+                while True:
+                    undo.append((group, s, group[s]))
+                    group[s] = head
+                    s = nxt[s]
+                    if s == g:
+                        break
+                undo.append((nxt, head, nxt[head]))
+                undo.append((nxt, g, nxt[g]))
+                nxt[head], nxt[g] = nxt[g], nxt[head]
 
-        board = board_put(self.board, c, 'X')
         # Test for captures, and track ko
         capX = self.cap[0]
         singlecaps = []
-        for d in neighbors(c):
-            if board[d] != 'x':
-                continue
-            # XXX: The following is an extremely naive and SLOW approach
-            # at things - to do it properly, we should maintain some per-group
-            # data structures tracking liberties.
-            fboard = floodfill(board, d)  # get a board with the adjecent group replaced by '#'
-            if contact(fboard, '.') is not None:
+        for g in enemies:
+            if libs[g]:
                 continue  # some liberties left
             # no liberties left for this group, remove the stones!
-            capcount = fboard.count('#')
+            capcount = 0
+            s = g
+            while True:
+                undo.append((board, s, other))
+                self.put(s, EMPTY)
+                self.hash ^= zobrist[other][s]
+                undo.append((group, s, g))
+                group[s] = 0
+                capcount += 1
+                s = nxt[s]
+                if s == g:
+                    break
+            undo.append((libs, g, libs[g]))
+            libs[g] = None
+            # ...and give the liberties back to groups around
+            while True:
+                for d in neighbors[s]:
+                    if board[d] == color:
+                        undo.append((libs, group[d], libs[group[d]]))
+                        libs[group[d]] = libs[group[d]] | {s}
+                s = nxt[s]
+                if s == g:
+                    break
             if capcount == 1:
-                singlecaps.append(d)
+                singlecaps.append(g)
             capX += capcount
-            board = fboard.replace('#', '.')  # capture the group
-        # Set ko
-        ko = singlecaps[0] if in_enemy_eye and len(singlecaps) == 1 else None
         # Test for suicide
-        if contact(floodfill(board, c), '.') is None:
-            return None
+        if not libs[group[c]]:
+            self.undo()
+            return False
+
+        # Set ko and update the captures
+        self.ko = singlecaps[0] if in_enemy_eye and len(singlecaps) == 1 else None
+        self.cap = (self.cap[1], capX)
+        return True
+
+    def undo(self):
+        """ take back the last play() """
+        undo, board = self.undo_log, self.board
+        undo_len, self.cap, self.ko, self.last, self.last2, self.hash = self.undo_marks.pop()
+        while len(undo) > undo_len:
+            a, i, v = undo.pop()
+            if a is board:
+                self.put(i, v)
+            else:
+                a[i] = v
+        self.n -= 1
 
-        # Update the position and return
-        return Position(board=board.swapcase(), cap=(self.cap[1], capX),
-                        n=self.n + 1, ko=ko, last=c, last2=self.last, komi=self.komi)
+    def move(self, c):
+        """ play as player to-play at the given coord c, return the new position """
+        pos = self.copy()
+        if not pos.play(c):
+            return None
+        return pos.compact()
 
     def pass_move(self):
-        """ pass - i.e. return simply a flipped position """
-        return Position(board=self.board.swapcase(), cap=(self.cap[1], self.cap[0]),
-                        n=self.n + 1, ko=None, last=None, last2=self.last, komi=self.komi)
-
-    def moves(self, i0):
-        """ Generate a list of moves (includes false positives - suicide moves;
-        does not include true-eye-filling moves), starting from a given board
-        index (that can be used for randomization) """
-        i = i0-1
-        passes = 0
-        while True:
-            i = self.board.find('.', i+1)
-            if passes > 0 and (i == -1 or i >= i0):
-                break  # we have looked through the whole board
-            elif i == -1:
-                i = 0
-                passes += 1
-                continue  # go back and start from the beginning
-            # Test for to-play player's one-point eye
-            if is_eye(self.board, i) == 'X':
-                continue
-            yield i
+        """ pass - i.e. return simply a position with the other player to play """
+        pos = self.copy()
+        pos.play(None)
+        return pos.compact()
 
     def last_moves_neighbors(self):
         """ generate a randomly shuffled list of points including and
@@ -294,49 +643,85 @@ class Position(namedtuple('Position', 'board cap n ko last last2 komi')):
         clist = []
         for c in self.last, self.last2:
             if c is None:  continue
-            dlist = [c] + list(neighbors(c) + diag_neighbors(c))
+            dlist = [c] + list(neighbors[c] + diag_neighbors[c])
             random.shuffle(dlist)
             clist += [d for d in dlist if d not in clist]
         return clist
 
-    def score(self, owner_map=None):
-        """ compute score for to-play player; this assumes a final position
-        with all dead stones captured; if owner_map is passed, it is assumed
-        to be an array of statistics with average owner at the end of the game
-        (+1 black, -1 white) """
+    def owners(self):
+        """ return a bytearray with the owner of each point in a final
+        position (with all dead stones captured): the color of its stone,
+        or of the stones surrounding its empty region - EMPTY if there
+        are stones of both colors (seki, rare) or none; OUT off-board """
         board = self.board
-        i = 0
-        while True:
-            i = self.board.find('.', i+1)
-            if i == -1:
-                break
-            fboard = floodfill(board, i)
-            # fboard is board with some continuous area of empty space replaced by #
-            touches_X = contact(fboard, 'X') is not None
-            touches_x = contact(fboard, 'x') is not None
-            if touches_X and not touches_x:
-                board = fboard.replace('#', 'X')
-            elif touches_x and not touches_X:
-                board = fboard.replace('#', 'x')
+        owners = bytearray(board)
+        # Label the empty regions in a single pass over the board: each
+        # point joins the regions of its left and upper neighbors (merging
+        # them if they are different), root[] links the points of a region
+        # towards its root and colors[root] collects the colors of the
+        # stones touching the region (BLACK and WHITE being bits).  Most
+        # regions at the end of a playout are single-point eyes, which are
+        # resolved right away.
+        bits = owner_bits
+        root = list(range(W*W))
+        colors = W*W*[0]
+        region_points = []
+        c = board.find(EMPTY)
+        while c != -1:
+            left, up, right, down = board[c-1], board[c-W], board[c+1], board[c+W]
+            touch = bits[left] | bits[up] | bits[right] | bits[down]
+            if left and up and right and down:
+                owners[c] = touch if touch != BLACK | WHITE else EMPTY
             else:
-                board = fboard.replace('#', ':')  # seki, rare
-            # now that area is replaced either by X, x or :
-        komi = self.komi if self.n % 2 == 1 else -self.komi
-        if owner_map is not None:
-            for c in range(W*W):
-                n = 1 if board[c] == 'X' else -1 if board[c] == 'x' else 0
-                owner_map[c] += n * (1 if self.n % 2 == 0 else -1)
-        return board.count('X') - board.count('x') + komi
+                r = c
+                if left == EMPTY:
+                    r = root[c-1]
+                    while root[r] != r:
+                        r = root[r]
+                if up == EMPTY:
+                    ru = root[c-W]
+                    while root[ru] != ru:
+                        ru = root[ru]
+                    if r == c:
+                        r = ru
+                    elif ru != r:
+                        root[ru] = r
+                        colors[r] |= colors[ru]
+                root[c] = r
+                colors[r] |= touch
+                region_points.append(c)
+            c = board.find(EMPTY, c+1)
+        for c in region_points:
+            r = root[c]
+            while root[r] != r:
+                r = root[r]
+            owners[c] = colors[r] if colors[r] != BLACK | WHITE else EMPTY
+        return owners
+
+    def score(self, owners=None):
+        """ compute score for to-play player; this assumes a final position
+        with all dead stones captured; owners is the result of owners()
+        if already at hand """
+        if owners is None:
+            owners = self.owners()
+        score = owners.count(BLACK) - owners.count(WHITE) - self.komi
+        return score if self.color == BLACK else -score
 
 
 def empty_position():
     """ Return an initial board position """
-    return Position(board=empty, cap=(0, 0), n=0, ko=None, last=None, last2=None, komi=7.5)
+    return Position(board=bytearray(empty), cap=(0, 0), n=0, ko=None, last=None, last2=None, komi=7.5,
+                    hash=0, history=frozenset())
 
 
 ###############
 # go heuristics
 
+# Ladder reading results by (position hash, color to play, ko, group head),
+# shared by all the fix_atari() calls - the same groups are checked from
+# each of their stones and in many similar positions
+ladder_memo = dict()
+
 def fix_atari(pos, c, singlept_ok=False, twolib_test=True, twolib_edgeonly=False):
     """ An atari/capture analysis routine that checks the group at c,
     determining whether (i) it is in atari (ii) if it can escape it,
@@ -363,76 +748,84 @@ def fix_atari(pos, c, singlept_ok=False, twolib_test=True, twolib_edgeonly=False
         """ check if a capturable ladder is being pulled out at c and return
         a move that continues it in that case; expects its two liberties as
         l1, l2  (in fact, this is a general 2-lib capture exhaustive solver) """
+        key = (pos.hash, pos.n % 2, pos.ko, pos.group[c])
+        try:
+            return ladder_memo[key]
+        except KeyError:
+            pass
+        attack = None
         for l in [l1, l2]:
-            pos_l = pos.move(l)
-            if pos_l is None:
+            if not pos.play(l):
                 continue
             # fix_atari() will recursively call read_ladder_attack() back;
             # however, ignore 2lib groups as we don't have time to chase them
-            is_atari, atari_escape = fix_atari(pos_l, c, twolib_test=False)
+            is_atari, atari_escape = fix_atari(pos, c, twolib_test=False)
+            pos.undo()
             if is_atari and not atari_escape:
-                return l
-        return None
-
-    fboard = floodfill(pos.board, c)
-    group_size = fboard.count('#')
-    if singlept_ok and group_size == 1:
+                attack = l
+                break
+        if len(ladder_memo) >= LADDER_MEMO_SIZE:
+            ladder_memo.clear()
+        ladder_memo[key] = attack
+        return attack
+
+    g = pos.group[c]
+    single = pos.nxt[g] == g
+    if singlept_ok and single:
         return (False, [])
-    # Find a liberty
-    l = contact(fboard, '.')
-    # Ok, any other liberty?
-    fboard = board_put(fboard, l, 'L')
-    l2 = contact(fboard, '.')
-    if l2 is not None:
+    libs = pos.liberties(c)
+    if len(libs) >= 2:
         # At least two liberty group...
-        if twolib_test and group_size > 1 \
-           and (not twolib_edgeonly or line_height(l) == 0 and line_height(l2) == 0) \
-           and contact(board_put(fboard, l2, 'L'), '.') is None:
-            # Exactly two liberty group with more than one stone.  Check
-            # that it cannot be caught in a working ladder; if it can,
-            # that's as good as in atari, a capture threat.
-            # (Almost - N/A for countercaptures.)
-            ladder_attack = read_ladder_attack(pos, c, l, l2)
-            if ladder_attack:
-                return (False, [ladder_attack])
+        if twolib_test and not single and len(libs) == 2:
+            l, l2 = libs
+            if not twolib_edgeonly or line_height[l] == 0 and line_height[l2] == 0:
+                # Exactly two liberty group with more than one stone.  Check
+                # that it cannot be caught in a working ladder; if it can,
+                # that's as good as in atari, a capture threat.
+                # (Almost - N/A for countercaptures.)
+                ladder_attack = read_ladder_attack(pos, c, l, l2)
+                if ladder_attack:
+                    return (False, [ladder_attack])
         return (False, [])
+    l, = libs
 
     # In atari! If it's the opponent's group, that's enough...
-    if pos.board[c] == 'x':
+    if pos.board[c] != pos.color:
         return (True, [l])
 
     solutions = []
 
     # Before thinking about defense, what about counter-capturing
     # a neighboring group?
-    ccboard = fboard
+    other = BLACK + WHITE - pos.color
+    othergroups = set()
+    s = g
     while True:
-        othergroup = contact(ccboard, 'x')
-        if othergroup is None:
+        for d in neighbors[s]:
+            if pos.board[d] == other and pos.group[d] not in othergroups:
+                othergroups.add(pos.group[d])
+                a, ccls = fix_atari(pos, d, twolib_test=False)
+                if a and ccls:
+                    solutions += ccls
+        s = pos.nxt[s]
+        if s == g:
             break
-        a, ccls = fix_atari(pos, othergroup, twolib_test=False)
-        if a and ccls:
-            solutions += ccls
-        # XXX: floodfill is better for big groups
-        ccboard = board_put(ccboard, othergroup, '%')
 
     # We are escaping.  Will playing our last liberty gain
-    # at least two liberties?  Re-floodfill to account for connecting
-    escpos = pos.move(l)
-    if escpos is None:
+    # at least two liberties?  (Including any groups we connect to.)
+    # We try the move in place and take it back when done.
+    if not pos.play(l):
         return (True, solutions)  # oops, suicidal move
-    fboard = floodfill(escpos.board, l)
-    l_new = contact(fboard, '.')
-    fboard = board_put(fboard, l_new, 'L')
-    l_new_2 = contact(fboard, '.')
-    if l_new_2 is not None:
+    libs_new = pos.liberties(l)
+    if len(libs_new) >= 2:
         # Good, there is still some liberty remaining - but if it's
         # just the two, check that we are not caught in a ladder...
         # (Except that we don't care if we already have some alternative
         # escape routes!)
-        if solutions or not (contact(board_put(fboard, l_new_2, 'L'), '.') is None
-                             and read_ladder_attack(escpos, l, l_new, l_new_2) is not None):
+        if solutions or not (len(libs_new) == 2
+                             and read_ladder_attack(pos, l, *libs_new) is not None):
             solutions.append(l)
+    pos.undo()
 
     return (True, solutions)
 
@@ -448,11 +841,11 @@ def cfg_distances(board, c):
     fringe = [c]
     while fringe:
         c = fringe.pop()
-        for d in neighbors(c):
-            if board[d].isspace() or 0 <= cfg_map[d] <= cfg_map[c]:
+        for d in neighbors[c]:
+            if board[d] == OUT or 0 <= cfg_map[d] <= cfg_map[c]:
                 continue
             cfg_before = cfg_map[d]
-            if board[d] != '.' and board[d] == board[c]:
+            if board[d] != EMPTY and board[d] == board[c]:
                 cfg_map[d] = cfg_map[c]
             else:
                 cfg_map[d] = cfg_map[c] + 1
@@ -461,19 +854,10 @@ def cfg_distances(board, c):
     return cfg_map
 
 
-def line_height(c):
-    """ Return the line number above nearest board edge """
-    row, col = divmod(c - (W+1), W)
-    return min(row, col, N-1-row, N-1-col)
-
-
-def empty_area(board, c, dist=3):
-    """ Check whether there are any stones in Manhattan distance up
-    to dist """
-    for d in neighbors(c):
-        if board[d] in 'Xx':
-            return False
-        elif board[d] == '.' and dist > 1 and not empty_area(board, d, dist-1):
+def empty_area(board, c):
+    """ Check whether there are no stones in Manhattan distance up to 3 """
+    for d in area3_points[c]:
+        if board[d] == BLACK or board[d] == WHITE:
             return False
     return True
 
@@ -509,10 +893,19 @@ def pat3_expand(pat):
 
 pat3set = set([p.replace('O', 'x') for p in pat3src for p in pat3_expand(p)])
 
-def neighborhood_33(board, c):
-    """ return a string containing the 9 points forming 3x3 square around
-    a certain move candidate """
-    return (board[c-W-1 : c-W+2] + board[c-1 : c+2] + board[c+W-1 : c+W+2]).replace('\n', ' ')
+def pat3_compile(pats):
+    """ compile a set of 3x3 pattern strings (with 'X' for the player to
+    play) to lookup tables indexed by neighborhood code, one for each
+    color of the player to play; pattern matching is then just
+    pat3table[color][pos.nbcode[c]] """
+    tables = [bytearray(4**8) for color in range(3)]
+    for color in (BLACK, WHITE):
+        colors = {'.': EMPTY, 'X': color, 'x': BLACK + WHITE - color, ' ': OUT}
+        for p in pats:
+            tables[color][sum(colors[p[i]] << 2*k for k, i in enumerate([0, 1, 2, 3, 5, 6, 7, 8]))] = 1
+    return tables
+
+pat3table = pat3_compile(pat3set)
 
 
 # large-scale pattern routines (those patterns living in patterns.{spat,prob} files)
@@ -521,7 +914,65 @@ def neighborhood_33(board, c):
 # https://github.com/pasky/pachi/blob/master/tools/pattern_spatial_show.pl
 # and try e.g. ./pattern_spatial_show.pl 71
 
-spat_patterndict = dict()  # hash(neighborhood_gridcular()) -> spatial id
+# A large pattern of a given diameter at point c is the sequence of
+# colors of the points at pat_gridcular_seq offsets up to that diameter
+# (in one of the 8 rotations), relative to the player to play.  We match
+# patterns by hash, xoring a Zobrist-like key of each (index in the
+# sequence, color); the hash of each diameter thus extends that of the
+# previous one by just the newly added points.
+# The keys are generated by splitmix64 from a seed, so the hashes are
+# the same in every process and run (unlike the built-in hash() of
+# strings), and can be stored in the compiled pattern database.
+gridcular_ends = [sum(len(dseq) for dseq in pat_gridcular_seq[:d+1]) for d in range(len(pat_gridcular_seq))]
+
+def splitmix64(x):
+    """ return the next state and the output of the splitmix64 generator in state x """
+    x = (x + 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+    z = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return x, z ^ (z >> 31)
+
+def set_pattern_seed(seed):
+    """ generate the large pattern hash keys from the given seed; patterns
+    loaded with different keys need to be loaded again """
+    global pattern_seed, pattern_relkeys, pattern_keys
+    pattern_seed = seed
+    pattern_relkeys = []
+    for i in range(gridcular_ends[-1]):
+        pattern_relkeys.append([])
+        for k in '.Xx ':
+            seed, key = splitmix64(seed)
+            pattern_relkeys[-1].append(key)
+    # keys indexed by color to play, sequence index and board color
+    pattern_keys = [None] + [[[keys[{EMPTY: 0, color: 1, BLACK+WHITE-color: 2, OUT: 3}[k]] for k in range(4)]
+                              for keys in pattern_relkeys] for color in (BLACK, WHITE)]
+
+set_pattern_seed(PATTERN_HASH_SEED)
+
+def pattern_hash(neighborhood):
+    """ hash of a pattern string with 'X' to play, 'x' other player, '.'
+    empty and ' ' off-board """
+    h = 0
+    for i, p in enumerate(neighborhood):
+        h ^= pattern_relkeys[i]['.Xx '.index(p)]
+    return h
+
+
+# (dy, dx) -> index of the diameter of pat_gridcular_seq the offset is part of
+gridcular_diameter = dict(((o[0], o[1]), d) for d, dseq in enumerate(pat_gridcular_seq) for o in dseq)
+
+def large_pattern_affected(c, diameters, changed):
+    """ test whether change of any of the changed points can affect the
+    large pattern matching at c that examined the given number of diameters """
+    cy, cx = divmod(c, W)
+    for s in changed:
+        sy, sx = divmod(s, W)
+        if gridcular_diameter.get((sy - cy, sx - cx), diameters) < diameters:
+            return True
+    return False
+
+
+spat_patterndict = dict()  # pattern_hash(neighborhood) -> spatial id
 def load_spat_patterndict(f):
     """ load dictionary of positions, translating them to numeric ids """
     for line in f:
@@ -529,7 +980,7 @@ def load_spat_patterndict(f):
         if line.startswith('#'):
             continue
         neighborhood = line.split()[2].replace('#', ' ').replace('O', 'x')
-        spat_patterndict[hash(neighborhood)] = int(line.split()[0])
+        spat_patterndict[pattern_hash(neighborhood)] = int(line.split()[0])
 
 large_patterns = dict()  # spatial id -> probability
 def load_large_patterns(f):
@@ -546,48 +997,148 @@ def load_large_patterns(f):
             large_patterns[s] = p
 
 
-def neighborhood_gridcular(board, c):
-    """ Yield progressively wider-diameter gridcular board neighborhood
-    stone configuration strings, in all possible rotations """
-    # Each rotations element is (xyindex, xymultiplier)
-    rotations = [((0,1),(1,1)), ((0,1),(-1,1)), ((0,1),(1,-1)), ((0,1),(-1,-1)),
-                 ((1,0),(1,1)), ((1,0),(-1,1)), ((1,0),(1,-1)), ((1,0),(-1,-1))]
-    neighborhood = ['' for i in range(len(rotations))]
-    wboard = board.replace('\n', ' ')
-    for dseq in pat_gridcular_seq:
-        for ri in range(len(rotations)):
-            r = rotations[ri]
-            for o in dseq:
-                y, x = divmod(c - (W+1), W)
-                y += o[r[0][0]]*r[1][0]
-                x += o[r[0][1]]*r[1][1]
-                if y >= 0 and y < N and x >= 0 and x < N:
-                    neighborhood[ri] += wboard[(y+1)*W + x+1]
-                else:
-                    neighborhood[ri] += ' '
-            yield neighborhood[ri]
-
-
-def large_pattern_probability(board, c):
-    """ return probability of large-scale pattern at coordinate c.
-    Multiple progressively wider patterns may match a single coordinate,
-    we consider the largest one. """
+# Large pattern probabilities by pattern hash - a dict made from the two
+# dicts above, or the PatternTable of a compiled pattern database
+pattern_probs = dict()
+def index_large_patterns():
+    """ fill pattern_probs from spat_patterndict and large_patterns """
+    for h, s in spat_patterndict.items():
+        if s in large_patterns:
+            pattern_probs[h] = large_patterns[s]
+
+
+# The compiled pattern database is a header followed by an open addressing
+# hash table of pattern probabilities with linear probing: n_slots (power
+# of two, at most half full) pattern hashes with 0 for empty slots, then
+# n_slots probabilities; all in native byte order.  The hashes are made
+# with the pattern hash seed in the header.
+PATTERN_DB_MAGIC = b'michipat'
+PATTERN_DB_HEADER = '=8sQQQQ'  # magic, version, seed, n_slots, n_patterns
+PATTERN_DB_VERSION = 2
+
+def compile_patterns(f):
+    """ write pattern_probs to the file f as a compiled pattern database """
+    n_slots = 2
+    while n_slots < 2 * len(pattern_probs):
+        n_slots *= 2
+    keys = array('Q', n_slots * [0])
+    probs = array('f', n_slots * [0])
+    for h, p in pattern_probs.items():
+        i = h & (n_slots - 1)
+        while keys[i] != 0:
+            i = (i + 1) & (n_slots - 1)
+        keys[i] = h
+        probs[i] = p
+    f.write(struct.pack(PATTERN_DB_HEADER, PATTERN_DB_MAGIC, PATTERN_DB_VERSION, pattern_seed,
+                        n_slots, len(pattern_probs)))
+    keys.tofile(f)
+    probs.tofile(f)
+
+
+class PatternTable():
+    """ Large pattern probabilities of a compiled pattern database, looked
+    up right in the file mapped to memory; that makes loading instant and
+    the pages are shared by all processes using the file; the database
+    pattern hash seed must be set by set_pattern_seed() to use it """
+    __slots__ = ['path', 'map', 'seed', 'mask', 'keys', 'probs']
+
+    def __init__(self, f):
+        self.path = f.name
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.seed, n_slots, n_patterns = struct.unpack_from(PATTERN_DB_HEADER, self.map)
+        if magic != PATTERN_DB_MAGIC or version != PATTERN_DB_VERSION:
+            raise IOError('%s is not a compiled pattern database of this version' % (f.name,))
+        start = struct.calcsize(PATTERN_DB_HEADER)
+        self.mask = n_slots - 1
+        self.keys = memoryview(self.map)[start : start + 8*n_slots].cast('Q')
+        self.probs = memoryview(self.map)[start + 8*n_slots : start + 12*n_slots].cast('f')
+
+    def get(self, h):
+        """ probability of the pattern with hash h, or None """
+        keys = self.keys
+        i = h & self.mask
+        while True:
+            if keys[i] == h:
+                return self.probs[i]
+            if keys[i] == 0:
+                return None
+            i = (i + 1) & self.mask
+
+
+def patterns_state():
+    """ return what init_worker() needs to set up the same board size and
+    large patterns in another process """
+    if isinstance(pattern_probs, PatternTable):
+        return (N, pattern_seed, pattern_probs.path)
+    return (N, pattern_seed, pattern_probs)
+
+
+def init_worker(state):
+    """ initialize a worker process with the board size and large patterns
+    as returned by patterns_state(); needed when the process does not start
+    as a copy of ours, i.e. with the spawn start method """
+    global pattern_probs
+    size, seed, patterns = state
+    if size != N:
+        set_board_size(size)
+    if isinstance(patterns, str):
+        with open(patterns, 'rb') as f:
+            patterns = PatternTable(f)
+    pattern_probs = patterns
+    if seed != pattern_seed:
+        set_pattern_seed(seed)
+
+
+def load_patterns():
+    """ load large patterns, from the compiled pattern database if there
+    is one, otherwise from the pattern files """
+    global pattern_probs
+    if os.path.exists(patterns_db_file):
+        with open(patterns_db_file, 'rb') as f:
+            print('Loading compiled patterns...', file=sys.stderr)
+            pattern_probs = PatternTable(f)
+        set_pattern_seed(pattern_probs.seed)
+        return
+    with open(spat_patterndict_file) as f:
+        print('Loading pattern spatial dictionary...', file=sys.stderr)
+        load_spat_patterndict(f)
+    with open(large_patterns_file) as f:
+        print('Loading large patterns...', file=sys.stderr)
+        load_large_patterns(f)
+    index_large_patterns()
+
+
+def large_pattern_probability(pos, c):
+    """ return probability of large-scale pattern at coordinate c for the
+    player to play, and the number of diameters examined (the board beyond
+    them does not matter).  Multiple progressively wider patterns may match
+    a single coordinate, we consider the largest one. """
+    board = pos.board
+    keys = pattern_keys[pos.color]
+    points = gridcular_table[c]
+    hashes = len(points) * [0]
     probability = None
     matched_len = 0
     non_matched_len = 0
-    for n in neighborhood_gridcular(board, c):
-        sp_i = spat_patterndict.get(hash(n))
-        prob = large_patterns.get(sp_i) if sp_i is not None else None
-        if prob is not None:
-            probability = prob
-            matched_len = len(n)
-        elif matched_len < non_matched_len < len(n):
-            # stop when we did not match any pattern with a certain
-            # diameter - it ain't going to get any better!
-            break
-        else:
-            non_matched_len = len(n)
-    return probability
+    start = 0
+    for d, end in enumerate(gridcular_ends):
+        for r, rpoints in enumerate(points):
+            h = hashes[r]
+            for i in range(start, end):
+                h ^= keys[i][board[rpoints[i]]]
+            hashes[r] = h
+            prob = pattern_probs.get(h)
+            if prob is not None:
+                probability = prob
+                matched_len = end
+            elif matched_len < non_matched_len < end:
+                # stop when we did not match any pattern with a certain
+                # diameter - it ain't going to get any better!
+                return probability, d + 1
+            else:
+                non_matched_len = end
+        start = end
+    return probability, len(gridcular_ends)
 
 
 ###########################
@@ -606,7 +1157,7 @@ def gen_playout_moves(pos, heuristic_set, probs={'capture': 1, 'pat3': 1}, expen
     if random.random() <= probs['capture']:
         already_suggested = set()
         for c in heuristic_set:
-            if pos.board[c] in 'Xx':
+            if pos.board[c] == BLACK or pos.board[c] == WHITE:
                 in_atari, ds = fix_atari(pos, c, twolib_edgeonly=not expensive_ok)
                 random.shuffle(ds)
                 for d in ds:
@@ -617,16 +1168,25 @@ def gen_playout_moves(pos, heuristic_set, probs={'capture': 1, 'pat3': 1}, expen
     # Try to apply a 3x3 pattern on the local neighborhood
     if random.random() <= probs['pat3']:
         already_suggested = set()
+        pat3 = pat3table[pos.color]
         for c in heuristic_set:
-            if pos.board[c] == '.' and c not in already_suggested and neighborhood_33(pos.board, c) in pat3set:
+            if pos.board[c] == EMPTY and c not in already_suggested and pat3[pos.nbcode[c]]:
                 yield (c, 'pat3')
                 already_suggested.add(c)
 
-    # Try *all* available moves, but starting from a random point
-    # (in other words, suggest a random move)
-    x, y = random.randint(1, N), random.randint(1, N)
-    for c in pos.moves(y*W + x):
-        yield (c, 'random')
+    # Try *all* available moves in random order (in other words, suggest
+    # a random move), except for the to-play player's true eyes; they are
+    # drawn from a copy of the empty points list, swapping each drawn one
+    # out of the part left to draw (the position may change meanwhile
+    # while trying out the moves)
+    empties = list(pos.empties)
+    color = pos.color
+    for i in range(len(empties) - 1, -1, -1):
+        k = int(random.random() * (i + 1))
+        c = empties[k]
+        empties[k] = empties[i]
+        if is_eye(pos.board, c) != color:
+            yield (c, 'random')
 
 
 def mcplayout(pos, amaf_map, disp=False):
@@ -636,209 +1196,993 @@ def mcplayout(pos, amaf_map, disp=False):
     position first """
     if disp:  print('** SIMULATION **', file=sys.stderr)
     start_n = pos.n
+    # The playout works on a private copy of the position, playing moves
+    # (and taking back rejected ones) in place
+    pos = pos.copy()
     passes = 0
     while passes < 2 and pos.n < MAX_GAME_LEN:
         if disp:  print_pos(pos)
 
-        pos2 = None
+        amaf_value = 1 if pos.n % 2 == 0 else -1
+        played = False
         # We simply try the moves our heuristics generate, in a particular
         # order, but not with 100% probability; this is on the border between
         # "rule-based playouts" and "probability distribution playouts".
         for c, kind in gen_playout_moves(pos, pos.last_moves_neighbors(), PROB_HEURISTIC):
             if disp and kind != 'random':
                 print('move suggestion', str_coord(c), kind, file=sys.stderr)
-            pos2 = pos.move(c)
-            if pos2 is None:
+            if not pos.play(c):
                 continue
             # check if the suggested move did not turn out to be a self-atari
             if random.random() <= (PROB_RSAREJECT if kind == 'random' else PROB_SSAREJECT):
-                in_atari, ds = fix_atari(pos2, c, singlept_ok=True, twolib_edgeonly=True)
+                in_atari, ds = fix_atari(pos, c, singlept_ok=True, twolib_edgeonly=True)
                 if ds:
                     if disp:  print('rejecting self-atari move', str_coord(c), file=sys.stderr)
-                    pos2 = None
+                    pos.undo()
                     continue
             if amaf_map[c] == 0:  # Mark the coordinate with 1 for black
-                amaf_map[c] = 1 if pos.n % 2 == 0 else -1
+                amaf_map[c] = amaf_value
+            played = True
             break
-        if pos2 is None:  # no valid moves, pass
-            pos = pos.pass_move()
+        if not played:  # no valid moves, pass
+            pos.play(None)
             passes += 1
             continue
         passes = 0
-        pos = pos2
 
-    owner_map = W*W*[0]
-    score = pos.score(owner_map)
+    owners = pos.owners()
+    score = pos.score(owners)
     if disp:  print('** SCORE B%+.1f **' % (score if pos.n % 2 == 0 else -score), file=sys.stderr)
     if start_n % 2 != pos.n % 2:
         score = -score
-    return score, amaf_map, owner_map
+    return score, amaf_map, owners
+
+
+def batch_shifted(a, off):
+    """ view of the (boards, W*W) array a at the neighbors in direction off
+    (0 for the points themselves) of the points from the first to the last
+    board point, i.e. all the board points and the border points between
+    their rows """
+    return a[:, W+1+off : W*W-W-1+off]
+
+
+def batch_labels(board, mask):
+    """ label the connected components of points in mask having the same
+    color in the (boards, W*W) array board; a component is labelled by the
+    smallest index of its points in the flattened array, points not in
+    mask by their own index """
+    B = board.shape[0]
+    lab = np.arange(B*W*W, dtype=np.int32).reshape(B, W*W)
+    labf = lab.ravel()
+    links = [(off, batch_shifted(mask, 0) & batch_shifted(mask, off)
+                   & (batch_shifted(board, 0) == batch_shifted(board, off)))
+             for off in (1, W)]
+    # Connected points with different labels link the larger label to the
+    # smaller one, then each point takes the label of its label until
+    # nothing changes (pointer jumping); labels thus form trees pointing
+    # to their smallest point, merged in few rounds
+    while True:
+        hooked = False
+        for off, link in links:
+            plab = batch_shifted(lab, 0)
+            nlab = batch_shifted(lab, off)
+            for lab1, lab2 in ((plab, nlab), (nlab, plab)):
+                m = link & (lab2 < lab1)
+                if m.any():
+                    np.minimum.at(labf, lab1[m], lab2[m])
+                    hooked = True
+        if not hooked:
+            return lab
+        while True:
+            jumped = labf[labf]
+            if (jumped == labf).all():
+                break
+            labf[:] = jumped
+
+
+def batch_playouts(positions, amaf_maps):
+    """ play out all the positions at once, advancing them in lockstep by
+    array operations on all the boards; returns arrays of the scores for
+    to-play player at each starting position, the amaf maps (filled in
+    as by mcplayout()) and the owners of each point (as Position.owners())
+
+    The playouts are uniformly random (except that no player fills its
+    own eyes, see is_eye()), not using the heuristics of mcplayout(), so
+    they are weaker but the boards need no per-move Python code.  The
+    liberties are counted as pseudo-liberties (an empty point adjacent
+    to a group from k sides counts k times); a group is then in atari
+    iff all its pseudo-liberties are the same point, i.e. iff n*sum(l^2)
+    == sum(l)^2 over its pseudo-liberty points l. """
+    B = len(positions)
+    offsets = (-W, -1, 1, W)
+    diag_offsets = (-W-1, -W+1, W-1, W+1)
+    coords = np.arange(W+1, W*W-W-1)  # of the points of batch_shifted() arrays
+    all_coords = np.arange(W*W, dtype=float)
+    board = np.frombuffer(b''.join(bytes(pos.board) for pos in positions), dtype=np.uint8).reshape(B, W*W).copy()
+    amaf = np.array(amaf_maps, dtype=np.int8).reshape(B, W*W)
+    color = np.array([pos.color for pos in positions], dtype=np.uint8)
+    start_color = color.copy()
+    ko = np.array([pos.ko or 0 for pos in positions])
+    n = np.array([pos.n for pos in positions])
+    passes = np.zeros(B, dtype=int)
+    komi = np.array([pos.komi for pos in positions])
+    active = n < MAX_GAME_LEN
+    rows = np.arange(B)
+    rng = np.random.default_rng(random.getrandbits(64))
+    # Group labels as by batch_labels(), kept up to date as stones are
+    # played and captured
+    index = np.arange(B*W*W, dtype=np.int32).reshape(B, W*W)
+    lab = batch_labels(board, (board == BLACK) | (board == WHITE))
+    labf = lab.ravel()
+
+    while active.any():
+        # Pseudo-liberties of the groups: the empty neighbors of each point,
+        # summed up by group label (empty points add up to their own labels,
+        # which are not those of any group; every group has a liberty)
+        is_empty = board == EMPTY
+        empty_n = is_empty.astype(float)
+        empty_sum = empty_n * all_coords
+        empty_sum2 = empty_sum * all_coords
+        libs_n = sum(batch_shifted(empty_n, off) for off in offsets)
+        libs_sum = sum(batch_shifted(empty_sum, off) for off in offsets)
+        libs_sum2 = sum(batch_shifted(empty_sum2, off) for off in offsets)
+        group = batch_shifted(lab, 0).ravel()
+        libs_n = np.bincount(group, weights=libs_n.ravel(), minlength=B*W*W)
+        libs_sum = np.bincount(group, weights=libs_sum.ravel(), minlength=B*W*W)
+        libs_sum2 = np.bincount(group, weights=libs_sum2.ravel(), minlength=B*W*W)
+        in_atari = (libs_n * libs_sum2 == libs_sum * libs_sum)[lab]
+
+        # Legal moves: empty points that are not suicide (have a liberty,
+        # join a group with another liberty or capture), not a ko
+        # retake and not our own eye
+        own = color[:, None]
+        other = BLACK + WHITE - own
+        has_lib = np.zeros((B, len(coords)), dtype=bool)
+        joins_safe = np.zeros_like(has_lib)
+        captures = np.zeros_like(has_lib)
+        not_own_eyeish = np.zeros_like(has_lib)
+        other_eyeish = np.ones_like(has_lib)
+        for off in offsets:
+            nb = batch_shifted(board, off)
+            nb_atari = batch_shifted(in_atari, off)
+            has_lib |= nb == EMPTY
+            joins_safe |= (nb == own) & ~nb_atari
+            captures |= (nb == other) & nb_atari
+            not_own_eyeish |= (nb == EMPTY) | (nb == other)
+            other_eyeish &= (nb == other) | (nb == OUT)
+        false_count = np.zeros(has_lib.shape, dtype=int)
+        at_edge = np.zeros_like(has_lib)
+        for off in diag_offsets:
+            nb = batch_shifted(board, off)
+            false_count += nb == other
+            at_edge |= nb == OUT
+        own_eye = ~not_own_eyeish & (false_count + at_edge < 2)
+        legal = (batch_shifted(is_empty, 0) & (has_lib | joins_safe | captures) & ~own_eye
+                 & (coords != ko[:, None]) & active[:, None])
+
+        # Play a random legal move on each board, or pass
+        j = np.where(legal, rng.random(legal.shape, dtype=np.float32), -1).argmax(axis=1)
+        played = legal[rows, j]
+        c = coords[j]
+        b = rows[played]
+        c_b = c[played]
+        board[b, c_b] = color[played]
+        kill = np.zeros(B*W*W, dtype=bool)
+        for off in offsets:
+            d = c_b + off
+            m = (board[b, d] == other[played, 0]) & in_atari[b, d]
+            kill[lab[b, d][m]] = True
+        captured = kill[lab]
+        board[captured] = EMPTY
+        lab[captured] = index[captured]
+        # The new stone joins the groups of its color around it: they
+        # all get the smallest of their labels, by relabelling the roots
+        # and then all the points (the labels are roots pointing to
+        # themselves, so one pointer jump is enough)
+        joined = index[b, c_b]
+        for off in offsets:
+            d = c_b + off
+            same = board[b, d] == color[played]
+            joined = np.where(same, np.minimum(joined, lab[b, d]), joined)
+        for off in offsets:
+            d = c_b + off
+            same = board[b, d] == color[played]
+            labf[lab[b, d][same]] = joined[same]
+        lab[b, c_b] = joined
+        labf[:] = labf[labf]
+        n_captured = captured.sum(axis=1)
+        ko = np.where(played & (n_captured == 1) & other_eyeish[rows, j], captured.argmax(axis=1), 0)
+        amaf_value = np.where(color == BLACK, 1, -1).astype(np.int8)
+        first = amaf[b, c_b] == 0
+        amaf[b[first], c_b[first]] = amaf_value[played][first]
+
+        passes = np.where(played, 0, passes + active)
+        n += active
+        color = np.where(active, BLACK + WHITE - color, color).astype(np.uint8)
+        active &= (passes < 2) & (n < MAX_GAME_LEN)
+
+    # Score the final positions by the colors touching the empty regions
+    is_empty = board == EMPTY
+    lab = batch_labels(board, is_empty)
+    owners = board.copy()
+    touches = dict()
+    for k in (BLACK, WHITE):
+        touches[k] = np.zeros(B*W*W, dtype=bool)
+        for off in offsets:
+            touches[k][batch_shifted(lab, 0)[batch_shifted(is_empty, 0) & (batch_shifted(board, off) == k)]] = True
+        touches[k] = touches[k][lab]
+    owners[is_empty & touches[BLACK] & ~touches[WHITE]] = BLACK
+    owners[is_empty & touches[WHITE] & ~touches[BLACK]] = WHITE
+    score = (owners == BLACK).sum(axis=1) - (owners == WHITE).sum(axis=1) - komi
+    return np.where(start_color == BLACK, score, -score), amaf, owners
 
 
 ########################
 # montecarlo tree search
 
+def move_priors(pos):
+    """ return a list of (coord, pv, pw) for the moves in pos suggested by
+    gen_playout_moves(), in the order of their first suggestion, with the
+    cheap prior values - those not needing the position after the move nor
+    large pattern matching; the moves are not tested for legality """
+    cfg_map = cfg_distances(pos.board, pos.last) if pos.last is not None else None
+    moves = []
+    priors = dict()  # coord -> [pv, pw]
+    # Use playout generator to generate the moves and their first priors.
+    # Note that there can be many ways to incorporate the priors in
+    # next node selection (progressive bias, progressive widening, ...).
+    for c, kind in gen_playout_moves(pos, list(range(N, (N+1)*W)), expensive_ok=True):
+        # gen_playout_moves() will generate duplicate suggestions
+        # if a move is yielded by multiple heuristics
+        try:
+            prior = priors[c]
+        except KeyError:
+            prior = priors[c] = [PRIOR_EVEN, PRIOR_EVEN/2]
+            moves.append(c)
+
+        if kind.startswith('capture'):
+            # Check how big group we are capturing; coord of the group is
+            # second word in the ``kind`` string
+            g = int(kind.split()[1])
+            if pos.nxt[g] != g:
+                prior[0] += PRIOR_CAPTURE_MANY
+                prior[1] += PRIOR_CAPTURE_MANY
+            else:
+                prior[0] += PRIOR_CAPTURE_ONE
+                prior[1] += PRIOR_CAPTURE_ONE
+        elif kind == 'pat3':
+            prior[0] += PRIOR_PAT3
+            prior[1] += PRIOR_PAT3
+
+    # Second pass setting priors, considering each move just once now
+    for c in moves:
+        prior = priors[c]
+        if cfg_map is not None and cfg_map[c]-1 < len(PRIOR_CFG):
+            prior[0] += PRIOR_CFG[cfg_map[c]-1]
+            prior[1] += PRIOR_CFG[cfg_map[c]-1]
+
+        height = line_height[c]  # 0-indexed
+        if height <= 2 and empty_area(pos.board, c):
+            # No stones around; negative prior for 1st + 2nd line, positive
+            # for 3rd line; sanitizes opening and invasions
+            if height <= 1:
+                prior[0] += PRIOR_EMPTYAREA
+                prior[1] += 0
+            if height == 2:
+                prior[0] += PRIOR_EMPTYAREA
+                prior[1] += PRIOR_EMPTYAREA
+
+    return [(c, priors[c][0], priors[c][1]) for c in moves]
+
+
+class PatternCache():
+    """ cache of large_pattern_probability() results by coord in a tree
+    node position, falling back to the cache of an ancestor position
+    (parent) for the matches not affected by the changed points of the
+    board since; only the matches done here are stored, so that the
+    cache does not grow with the depth of the tree """
+    __slots__ = ['matches', 'parent', 'changed']
+
+    def __init__(self, parent=None, changed=()):
+        self.matches = dict()
+        self.parent = parent
+        self.changed = changed
+
+    def get(self, c):
+        match = self.matches.get(c)
+        if match is None and self.parent is not None:
+            match = self.parent.get(c)
+            if match is not None and large_pattern_affected(c, match[1], self.changed):
+                match = None
+        return match
+
+    def __setitem__(self, c, match):
+        self.matches[c] = match
+
+
+def large_pattern_prior(pos, c, pattern_cache):
+    """ prior value of move c in pos for matching a large pattern; pattern_cache
+    is a dict of large_pattern_probability() results by coord (or
+    a PatternCache), used and filled here """
+    match = pattern_cache.get(c)
+    if match is None:
+        match = pattern_cache[c] = large_pattern_probability(pos, c)
+    patternprob = match[0]
+    if patternprob is not None and patternprob > 0.001:
+        return math.sqrt(patternprob) * PRIOR_LARGEPATTERN  # tone up
+    return 0
+
+
+def expand_moves(pos, history, pattern_cache=None):
+    """ return a list of (coord, position, pv, pw) for all sensible moves
+    in pos, with prior values initializing the tree nodes to bias search
+    towards more sensible moves; moves repeating a position whose hash is
+    in history are forbidden by the positional superko rule; pattern_cache
+    is an optional dict of large_pattern_probability() results by coord,
+    used and filled here; the moves are tried out in pos in place (which
+    must not be a compact one) """
+    if pattern_cache is None:
+        pattern_cache = dict()
+    children = []
+    for c, pv, pw in move_priors(pos):
+        if not pos.play(c):
+            continue
+        if pos.hash in history:
+            pos.undo()
+            continue
+
+        in_atari, ds = fix_atari(pos, c, singlept_ok=True)
+        if ds:
+            pv += PRIOR_SELFATARI
+            pw += 0  # negative prior
+        pos2 = pos.compact()
+        pos.undo()
+
+        pattern_prior = large_pattern_prior(pos, c, pattern_cache)
+        pv += pattern_prior
+        pw += pattern_prior
+        children.append((c, pos2, pv, pw))
+
+    return children
+
+
+def widening(v):
+    """ number of the children of a lazily expanded node with v visits
+    open to selection (see TreeNode.widen()) """
+    return WIDENING_BASE + int(WIDENING_RATE * math.sqrt(v))
+
+
+def rave_urgency(v, w, pv, pw, av, aw):
+    """ node urgency in the RAVE tree policy, given its statistics as in
+    TreeNode """
+    v += pv
+    expectation = float(w+pw) / v
+    if av == 0:
+        return expectation
+    rave_expectation = float(aw) / av
+    beta = av / (av + v + float(v) * av / RAVE_EQUIV)
+    return beta * rave_expectation + (1-beta) * expectation
+
+
+class TranspositionTable():
+    """ A bounded map from Position.key() to tree nodes, letting positions
+    reached by different move orders share a single TreeNode (with its
+    subtree and the statistics of its children); least recently used
+    entries are evicted when the table is full """
+    __slots__ = ['size', 'nodes']
+
+    def __init__(self, size):
+        self.size = size
+        self.nodes = OrderedDict()
+
+    def get(self, pos):
+        node = self.nodes.get(pos.key())
+        if node is not None:
+            self.nodes.move_to_end(pos.key())
+        return node
+
+    def put(self, node):
+        self.nodes[node.pos.key()] = node
+        if len(self.nodes) > self.size:
+            self.nodes.popitem(last=False)
+
+    def clear(self):
+        self.nodes.clear()
+
+    def retain(self, nodes):
+        """ drop all entries except those of the given nodes """
+        ids = set(id(node) for node in nodes)
+        self.nodes = OrderedDict((k, node) for k, node in self.nodes.items() if id(node) in ids)
+
+transpositions = TranspositionTable(TT_SIZE) if TT_SIZE > 0 else None
+
+
+def position_key(pos):
+    """ return the key of pos in the position book, the same for all the
+    positions symmetric to it, and the indices of the symmetries that map
+    pos to the canonical one of them (the one with the lowest stones hash) """
+    stones = [c for c in board_points if pos.board[c] != EMPTY]
+    hashes = []
+    for sym in symmetries:
+        h = 0
+        for c in stones:
+            h ^= zobrist[pos.board[c]][sym[c]]
+        if pos.ko is not None:
+            h ^= splitmix64(sym[pos.ko])[1]
+        hashes.append(h)
+    h = min(hashes)
+    # Tell apart the board sizes, the player to play and the komi
+    key = splitmix64(h ^ splitmix64(N << 16 | (pos.n % 2) << 15 | int(pos.komi * 2) & 0x7fff)[1])[1]
+    return key or 1, [k for k, h2 in enumerate(hashes) if h2 == h]
+
+
+BOOK_MAGIC = b'michibok'
+BOOK_HEADER = '=8sQQQQ'  # magic, version, n_slots, entry_moves, n_positions
+BOOK_VERSION = 2
+
+class PositionBook():
+    """ Search statistics of opening positions kept across games and runs,
+    in a hash table in a file mapped to memory (laid out like the compiled
+    pattern database) that can be shared by several processes; positions
+    are keyed by position_key() and have the visits and wins (as in the
+    TreeNode arrays) of their BOOK_ENTRY_MOVES most visited moves, given
+    in the canonical orientation of the position """
+    __slots__ = ['file', 'map', 'mask', 'keys', 'moves', 'mv', 'mw']
+
+    def __init__(self, path, n_slots=BOOK_SLOTS):
+        k = BOOK_ENTRY_MOVES
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(struct.pack(BOOK_HEADER, BOOK_MAGIC, BOOK_VERSION, n_slots, k, 0))
+                f.truncate(struct.calcsize(BOOK_HEADER) + n_slots * (8 + 10*k))
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, version, n_slots, entry_moves, n_positions = struct.unpack_from(BOOK_HEADER, self.map)
+        if magic != BOOK_MAGIC or version != BOOK_VERSION:
+            raise IOError('%s is not a position book of this version' % (path,))
+        if entry_moves != k:
+            raise IOError('%s keeps %d moves per position, not %d' % (path, entry_moves, k))
+        start = struct.calcsize(BOOK_HEADER)
+        self.mask = n_slots - 1
+        view = memoryview(self.map)
+        self.keys = view[start : start + 8*n_slots].cast('Q')
+        start += 8*n_slots
+        self.moves = view[start : start + 2*k*n_slots].cast('H')  # 0 for unused
+        start += 2*k*n_slots
+        self.mv = view[start : start + 4*k*n_slots].cast('I')
+        start += 4*k*n_slots
+        self.mw = view[start : start + 4*k*n_slots].cast('I')
+
+    def slot(self, key):
+        """ index of the entry with the given key, or of the free one where
+        it would be added """
+        keys = self.keys
+        i = key & self.mask
+        while keys[i] != key and keys[i] != 0:
+            i = (i + 1) & self.mask
+        return i
+
+    def get(self, pos):
+        """ dict of (visits, wins) of the moves of pos in the book by coord """
+        key, syms = position_key(pos)
+        i = self.slot(key)
+        if self.keys[i] != key:
+            return dict()
+        k = BOOK_ENTRY_MOVES
+        inverse = inverse_symmetries[syms[0]]
+        return dict((inverse[self.moves[j]], (self.mv[j], self.mw[j]))
+                    for j in range(i*k, (i+1)*k) if self.moves[j])
+
+    def add(self, pos, stats):
+        """ add the dict of (visits, wins) by coord of moves of pos to the
+        book, keeping the most visited ones """
+        key, syms = position_key(pos)
+        # Moves equivalent in a symmetric position are counted as one
+        merged = dict()
+        for c, (v, w) in stats.items():
+            m = min(symmetries[k][c] for k in syms)
+            v0, w0 = merged.get(m, (0, 0))
+            merged[m] = (v0 + v, w0 + w)
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            i = self.slot(key)
+            k = BOOK_ENTRY_MOVES
+            if self.keys[i] != key:
+                n_positions = struct.unpack_from(BOOK_HEADER, self.map)[4]
+                if 2 * (n_positions + 1) > self.mask + 1:
+                    return  # the book is full
+                struct.pack_into(BOOK_HEADER, self.map, 0, BOOK_MAGIC, BOOK_VERSION, self.mask + 1, k, n_positions + 1)
+            for j in range(i*k, (i+1)*k):
+                m = self.moves[j]
+                if m and self.keys[i] == key:
+                    v0, w0 = merged.get(m, (0, 0))
+                    merged[m] = (v0 + self.mv[j], w0 + self.mw[j])
+            best = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)[:k]
+            # Scale down the counts of a much played position to fit them,
+            # keeping the winrates and the order of the moves
+            while best[0][1][0] > 0xffffffff:
+                best = [(m, (v // 2, w // 2)) for m, (v, w) in best]
+            best += (k - len(best)) * [(0, (0, 0))]
+            for j, (m, (v, w)) in zip(range(i*k, (i+1)*k), best):
+                self.moves[j], self.mv[j], self.mw[j] = m, v, w
+            # Publish the key last, for the processes reading meanwhile
+            self.keys[i] = key
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+book = None  # the PositionBook in use, if any
+
+def open_book(path=book_file):
+    """ start using the position book in the file path, creating it if needed """
+    global book
+    book = PositionBook(path)
+
+
+def book_priors(pos):
+    """ dict of the extra prior values (pv, pw) by coord of the moves of pos
+    in the position book, their visits capped at BOOK_PRIOR_VISITS """
+    if book is None or pos.n >= BOOK_MOVES:
+        return dict()
+    priors = dict()
+    for c, (v, w) in book.get(pos).items():
+        pv = min(v, BOOK_PRIOR_VISITS)
+        priors[c] = (pv, pv * float(w) / v)
+    return priors
+
+
+def book_move(pos):
+    """ the move of pos in the position book good to play without searching
+    (one with at least BOOK_INSTANT_VISITS visits and winrate not below
+    RESIGN_THRES, the most visited one), or None """
+    if book is None or pos.n >= BOOK_MOVES:
+        return None
+    stats = book.get(pos)
+    if not stats:
+        return None
+    c, (v, w) = max(stats.items(), key=lambda item: item[1][0])
+    if v < BOOK_INSTANT_VISITS or float(w) / v < RESIGN_THRES:
+        return None
+    pos2 = pos.move(c)
+    if pos2 is None or pos2.hash in pos.history:
+        return None
+    return c
+
+
+def book_snapshot(tree):
+    """ dict of the (visits, wins) of the moves of the root tree by coord,
+    for book_record() to store what a search adds to them """
+    if book is None or tree.children is None:
+        return dict()
+    return dict((c, (tree.cv[i], tree.cw[i])) for i, c in enumerate(tree.moves) if c is not None)
+
+
+def book_record(tree, snapshot):
+    """ add the visits and wins of the moves of the root tree, less those
+    of the book_snapshot() taken before the search, to the position book """
+    if book is None or tree.pos.n >= BOOK_MOVES or tree.children is None:
+        return
+    stats = dict()
+    for i, c in enumerate(tree.moves):
+        v0, w0 = snapshot.get(c, (0, 0))
+        if c is not None and tree.cv[i] > v0:
+            stats[c] = (int(tree.cv[i] - v0), int(tree.cw[i] - w0))
+    if stats:
+        book.add(tree.pos, stats)
+
+
+def stats_array(values):
+    """ make an array of tree statistics from the given values; NumPy
+    array if available so that whole arrays can be operated on at once """
+    return np.array(values, dtype=float) if np is not None else [float(x) for x in values]
+
+
+def stats_append(a, values):
+    """ return the array of tree statistics a extended by the given values """
+    return np.append(a, values) if np is not None else a + [float(x) for x in values]
+
+
+def move_array(moves):
+    """ make an array of the coordinates of moves (0 for pass) to index
+    amaf maps with, or None without NumPy """
+    return np.array([c or 0 for c in moves], dtype=np.intp) if np is not None else None
+
+
 class TreeNode():
     """ Monte-Carlo tree node;
-    v is #visits, w is #wins for to-play (expected reward is w/v)
-    pv, pw are prior values (node value = w/v + pw/pv)
-    av, aw are amaf values ("all moves as first", used for the RAVE tree policy)
-    children is None for leaf nodes """
+    v is #visits (through any parent, with transpositions)
+    children is None for leaf nodes, otherwise a list of child nodes
+    (None for the ones not created yet, see child());
+    statistics of the moves leading to them are kept in arrays of the
+    parent, indexed like children, to allow selecting a child at once:
+    moves are the coordinates of the moves (None for pass), cmoves
+    the same in an array as made by move_array()
+    cv is #visits, cw is #wins for to-play at the child (expected reward is cw/cv)
+    cpv, cpw are prior values (move value = cw/cv + cpw/cpv)
+    cav, caw are amaf values ("all moves as first", used for the RAVE tree policy)
+    candidates are the (coord, pv, pw) of moves of a lazily expanded node
+    not open to selection yet, the most promising last (see widen())
+    patterns is the PatternCache of large patterns matched in expand() """
+    __slots__ = ['pos', 'v', 'children', 'moves', 'cmoves', 'cv', 'cw', 'cpv', 'cpw', 'cav', 'caw', 'candidates',
+                 'patterns']
+
     def __init__(self, pos):
         self.pos = pos
         self.v = 0
-        self.w = 0
-        self.pv = PRIOR_EVEN
-        self.pw = PRIOR_EVEN/2
-        self.av = 0
-        self.aw = 0
         self.children = None
-
-    def expand(self):
-        """ add and initialize children to a leaf node """
-        cfg_map = cfg_distances(self.pos.board, self.pos.last) if self.pos.last is not None else None
-        self.children = []
-        childset = dict()
-        # Use playout generator to generate children and initialize them
-        # with some priors to bias search towards more sensible moves.
-        # Note that there can be many ways to incorporate the priors in
-        # next node selection (progressive bias, progressive widening, ...).
-        for c, kind in gen_playout_moves(self.pos, list(range(N, (N+1)*W)), expensive_ok=True):
-            pos2 = self.pos.move(c)
-            if pos2 is None:
-                continue
-            # gen_playout_moves() will generate duplicate suggestions
-            # if a move is yielded by multiple heuristics
-            try:
-                node = childset[pos2.last]
-            except KeyError:
-                node = TreeNode(pos2)
-                self.children.append(node)
-                childset[pos2.last] = node
-
-            if kind.startswith('capture'):
-                # Check how big group we are capturing; coord of the group is
-                # second word in the ``kind`` string
-                if floodfill(self.pos.board, int(kind.split()[1])).count('#') > 1:
-                    node.pv += PRIOR_CAPTURE_MANY
-                    node.pw += PRIOR_CAPTURE_MANY
-                else:
-                    node.pv += PRIOR_CAPTURE_ONE
-                    node.pw += PRIOR_CAPTURE_ONE
-            elif kind == 'pat3':
-                node.pv += PRIOR_PAT3
-                node.pw += PRIOR_PAT3
-
-        # Second pass setting priors, considering each move just once now
-        for node in self.children:
-            c = node.pos.last
-
-            if cfg_map is not None and cfg_map[c]-1 < len(PRIOR_CFG):
-                node.pv += PRIOR_CFG[cfg_map[c]-1]
-                node.pw += PRIOR_CFG[cfg_map[c]-1]
-
-            height = line_height(c)  # 0-indexed
-            if height <= 2 and empty_area(self.pos.board, c):
-                # No stones around; negative prior for 1st + 2nd line, positive
-                # for 3rd line; sanitizes opening and invasions
-                if height <= 1:
-                    node.pv += PRIOR_EMPTYAREA
-                    node.pw += 0
-                if height == 2:
-                    node.pv += PRIOR_EMPTYAREA
-                    node.pw += PRIOR_EMPTYAREA
-
-            in_atari, ds = fix_atari(node.pos, c, singlept_ok=True)
-            if ds:
-                node.pv += PRIOR_SELFATARI
-                node.pw += 0  # negative prior
-
-            patternprob = large_pattern_probability(self.pos.board, c)
-            if patternprob is not None and patternprob > 0.001:
-                pattern_prior = math.sqrt(patternprob)  # tone up
-                node.pv += pattern_prior * PRIOR_LARGEPATTERN
-                node.pw += pattern_prior * PRIOR_LARGEPATTERN
-
-        if not self.children:
+        self.candidates = None
+        self.patterns = None
+
+    def prune(self):
+        """ turn the node back into a leaf, dropping its subtree """
+        self.children = self.moves = self.cmoves = self.candidates = self.patterns = None
+        self.cv = self.cw = self.cpv = self.cpw = self.cav = self.caw = None
+
+    def set_children(self, children, moves, pvs, pws):
+        """ make the node an inner node with the given children, reached
+        by the given moves with the given priors """
+        self.children = children
+        self.moves = moves
+        self.cmoves = move_array(moves)
+        self.cv = stats_array([0] * len(moves))
+        self.cw = stats_array([0] * len(moves))
+        self.cpv = stats_array(pvs)
+        self.cpw = stats_array(pws)
+        self.cav = stats_array([0] * len(moves))
+        self.caw = stats_array([0] * len(moves))
+
+    def expand(self, history=None, ancestor=None, lazy=LAZY_EXPAND):
+        """ add and initialize children to a leaf node; history is the set
+        of hashes of all positions preceding the children in the game and
+        tree (i.e. including this node), see expand_moves(); ancestor is
+        an optional node two moves up, with the same player to play, whose
+        large pattern matches are reused where the board did not change
+
+        With lazy, only the cheap priors of move_priors() are computed for
+        all the moves; they become candidates opened by widen() in the order
+        of these priors, which tests their legality and adds the expensive
+        priors, and their positions are created once they are selected """
+        if history is None:
+            history = self.pos.history | {self.pos.hash}
+        if ancestor is not None and ancestor.patterns is not None:
+            changed = [c for c in board_points if ancestor.pos.board[c] != self.pos.board[c]]
+            self.patterns = PatternCache(ancestor.patterns, changed)
+        else:
+            self.patterns = PatternCache()
+        # Ladder reading tries out moves in place, so work on a scratch copy;
+        # the node position may be pickled for a playout meanwhile
+        pos = self.pos.copy()
+        children, moves, pvs, pws = [], [], [], []
+        # Moves searched in earlier games get their results as priors
+        extra = book_priors(pos)
+        if lazy:
+            candidates = [(c, pv + extra[c][0], pw + extra[c][1]) if c in extra else (c, pv, pw)
+                          for c, pv, pw in move_priors(pos)]
+            # pop() takes the best first, and the first suggested of equal ones
+            self.candidates = sorted(reversed(candidates), key=lambda m: m[2] / m[1])
+            self.set_children([], [], [], [])
+            self.widen(widening(self.v), history)
+            if self.children:
+                return
+            self.candidates = None
+        else:
+            for c, pos2, pv, pw in expand_moves(pos, history, self.patterns):
+                # Positions reached by a different move order already may have
+                # their node (and its subtree) in the transposition table
+                node = transpositions.get(pos2) if transpositions is not None else None
+                if node is None:
+                    node = TreeNode(pos2)
+                    if transpositions is not None:
+                        transpositions.put(node)
+                children.append(node)
+                moves.append(c)
+                pvs.append(pv + extra[c][0] if c in extra else pv)
+                pws.append(pw + extra[c][1] if c in extra else pw)
+
+        if not children:
             # No possible moves, add a pass move
-            self.children.append(TreeNode(self.pos.pass_move()))
+            children, moves = [TreeNode(self.pos.pass_move())], [None]
+            pvs, pws = [PRIOR_EVEN], [PRIOR_EVEN/2]
+        self.set_children(children, moves, pvs, pws)
+
+    def widen(self, width=None, history=None):
+        """ open the candidates of a lazily expanded node to selection until
+        it has width (or all, if None) children, skipping illegal moves
+        (history is as in expand()) and adding the self-atari and large
+        pattern priors; the children are left to be created by child() """
+        if not self.candidates:
+            return
+        if history is None:
+            history = self.pos.history | {self.pos.hash}
+        # Moves are tried out on a scratch copy, as in expand()
+        pos = self.pos.copy()
+        moves, pvs, pws = [], [], []
+        while self.candidates and (width is None or len(self.moves) + len(moves) < width):
+            c, pv, pw = self.candidates.pop()
+            if not pos.play(c):
+                continue
+            legal = pos.hash not in history
+            if legal:
+                in_atari, ds = fix_atari(pos, c, singlept_ok=True)
+                if ds:
+                    pv += PRIOR_SELFATARI
+                    pw += 0  # negative prior
+            pos.undo()
+            if not legal:
+                continue
 
-    def rave_urgency(self):
-        v = self.v + self.pv
-        expectation = float(self.w+self.pw) / v
-        if self.av == 0:
-            return expectation
-        rave_expectation = float(self.aw) / self.av
-        beta = self.av / (self.av + v + float(v) * self.av / RAVE_EQUIV)
-        return beta * rave_expectation + (1-beta) * expectation
+            pattern_prior = large_pattern_prior(self.pos, c, self.patterns)
+            moves.append(c)
+            pvs.append(pv + pattern_prior)
+            pws.append(pw + pattern_prior)
+        self.children = self.children + [None] * len(moves)
+        self.moves = self.moves + moves
+        if np is not None:
+            self.cmoves = np.append(self.cmoves, move_array(moves))
+        self.cv = stats_append(self.cv, [0] * len(moves))
+        self.cw = stats_append(self.cw, [0] * len(moves))
+        self.cpv = stats_append(self.cpv, pvs)
+        self.cpw = stats_append(self.cpw, pws)
+        self.cav = stats_append(self.cav, [0] * len(moves))
+        self.caw = stats_append(self.caw, [0] * len(moves))
+
+    def child(self, i):
+        """ return the i-th child, creating it if needed """
+        node = self.children[i]
+        return node if node is not None else self.make_child(i)
+
+    def make_child(self, i):
+        """ create the i-th child, reusing the node of its position from
+        the transposition table if there is one """
+        c = self.moves[i]
+        pos2 = self.pos.move(c) if c is not None else self.pos.pass_move()
+        node = transpositions.get(pos2) if transpositions is not None else None
+        if node is None:
+            node = TreeNode(pos2)
+            node.v = int(self.cv[i])
+            if transpositions is not None:
+                transpositions.put(node)
+        self.children[i] = node
+        return node
+
+    def rave_urgency(self, i):
+        return rave_urgency(self.cv[i], self.cw[i], self.cpv[i], self.cpw[i], self.cav[i], self.caw[i])
+
+    def urgencies(self):
+        """ rave_urgency() of all the children at once """
+        if np is None:
+            return [self.rave_urgency(i) for i in range(len(self.children))]
+        v = self.cv + self.cpv
+        expectation = (self.cw + self.cpw) / v
+        beta = self.cav / (self.cav + v + v * self.cav / RAVE_EQUIV)
+        return beta * (self.caw / np.maximum(self.cav, 1)) + (1 - beta) * expectation
+
+    def most_urgent(self):
+        """ index of the child with the highest urgency, a random one of
+        them in case of equal urgency """
+        urgencies = self.urgencies()
+        if np is None:
+            best_urgency = max(urgencies)
+            best = [i for i, u in enumerate(urgencies) if u == best_urgency]
+        else:
+            best = np.flatnonzero(urgencies == urgencies.max())
+        return int(best[0]) if len(best) == 1 else int(random.choice(best))
 
-    def winrate(self):
-        return float(self.w) / self.v if self.v > 0 else float('nan')
+    def winrate(self, i):
+        """ expected reward of the i-th child """
+        return float(self.cw[i]) / self.cv[i] if self.cv[i] > 0 else float('nan')
 
     def best_move(self):
-        """ best move is the most simulated one """
-        return max(self.children, key=lambda node: node.v) if self.children is not None else None
+        """ index of the best move; best move is the most simulated one """
+        if self.children is None:
+            return None
+        if np is None:
+            return max(range(len(self.children)), key=lambda i: self.cv[i])
+        return int(np.argmax(self.cv))
 
 
 def tree_descend(tree, amaf_map, disp=False):
-    """ Descend through the tree to a leaf """
+    """ Descend through the tree to a leaf; return the list of nodes on
+    the path and the list of indices of each node among the children
+    of the previous one """
     tree.v += 1
     nodes = [tree]
+    indices = [None]
     passes = 0
     while nodes[-1].children is not None and passes < 2:
-        if disp:  print_pos(nodes[-1].pos)
+        parent = nodes[-1]
+        if disp:  print_pos(parent.pos)
+
+        # Open more moves of a lazily expanded node as it gets visits
+        if parent.candidates and len(parent.moves) < widening(parent.v):
+            parent.widen(widening(parent.v), tree.pos.history.union([n.pos.hash for n in nodes]))
 
         # Pick the most urgent child
-        children = list(nodes[-1].children)
         if disp:
-            for c in children:
-                dump_subtree(c, recurse=False)
-        random.shuffle(children)  # randomize the max in case of equal urgency
-        node = max(children, key=lambda node: node.rave_urgency())
+            for i in range(len(parent.children)):
+                dump_move(parent, i)
+        i = parent.most_urgent()
+        node = parent.child(i)
         nodes.append(node)
+        indices.append(i)
 
-        if disp:  print('chosen %s' % (str_coord(node.pos.last),), file=sys.stderr)
-        if node.pos.last is None:
+        move = parent.moves[i]
+        if disp:  print('chosen %s' % (str_coord(move),), file=sys.stderr)
+        if move is None:
             passes += 1
         else:
             passes = 0
-            if amaf_map[node.pos.last] == 0:  # Mark the coordinate with 1 for black
-                amaf_map[node.pos.last] = 1 if nodes[-2].pos.n % 2 == 0 else -1
+            if amaf_map[move] == 0:  # Mark the coordinate with 1 for black
+                amaf_map[move] = 1 if parent.pos.n % 2 == 0 else -1
 
         # updating visits on the way *down* represents "virtual loss", relevant for parallelization
+        parent.cv[i] += 1
         node.v += 1
-        if node.children is None and node.v >= EXPAND_VISITS:
-            node.expand()
+        if node.children is None and node.v >= (LAZY_EXPAND_VISITS if LAZY_EXPAND else EXPAND_VISITS):
+            node.expand(tree.pos.history.union([n.pos.hash for n in nodes]), nodes[-3] if len(nodes) >= 3 else None)
 
-    return nodes
+    return nodes, indices
 
 
-def tree_update(nodes, amaf_map, score, disp=False):
-    """ Store simulation result in the tree (@nodes is the tree path) """
-    for node in reversed(nodes):
+def tree_update(nodes, indices, amaf_map, score, disp=False):
+    """ Store simulation result in the tree (@nodes is the tree path,
+    @indices the child indices along it as returned by tree_descend()) """
+    if np is not None:
+        amaf = np.asarray(amaf_map)
+    for depth in range(len(nodes)-1, -1, -1):
+        node = nodes[depth]
         if disp:  print('updating', str_coord(node.pos.last), score < 0, file=sys.stderr)
-        node.w += score < 0  # score is for to-play, node statistics for just-played
+        if depth > 0:
+            nodes[depth-1].cw[indices[depth]] += score < 0  # score is for to-play, move statistics for just-played
         # Update the node children AMAF stats with moves we made
-        # with their color
+        # with their color; all at once by masking the amaf map gathered
+        # at the children moves (a pass indexes the always 0 point 0)
         amaf_map_value = 1 if node.pos.n % 2 == 0 else -1
-        if node.children is not None:
-            for child in node.children:
-                if child.pos.last is None:
+        if node.children is not None and np is not None and not disp:
+            played = amaf[node.cmoves] == amaf_map_value
+            node.cav += played
+            if score > 0:  # reversed perspective
+                node.caw += played
+        elif node.children is not None:
+            for i, move in enumerate(node.moves):
+                if move is None:
                     continue
-                if amaf_map[child.pos.last] == amaf_map_value:
-                    if disp:  print('  AMAF updating', str_coord(child.pos.last), score > 0, file=sys.stderr)
-                    child.aw += score > 0  # reversed perspective
-                    child.av += 1
+                if amaf_map[move] == amaf_map_value:
+                    if disp:  print('  AMAF updating', str_coord(move), score > 0, file=sys.stderr)
+                    node.caw[i] += score > 0  # reversed perspective
+                    node.cav[i] += 1
         score = -score
 
 
+def tree_nodes(tree):
+    """ list of all the distinct nodes of the tree """
+    nodes = [tree]
+    seen = set([id(tree)])
+    i = 0
+    while i < len(nodes):
+        if nodes[i].children is not None:
+            for child in nodes[i].children:
+                if child is not None and id(child) not in seen:
+                    seen.add(id(child))
+                    nodes.append(child)
+        i += 1
+    return nodes
+
+
+def node_memory(node):
+    """ rough estimate of the bytes taken by a game tree node with its
+    position, and its statistics of the children and candidates if it
+    is expanded; a leaf takes about 0.5KB on 9x9 and 0.9KB on 19x19,
+    a lazily expanded node tens of KB on 19x19 """
+    size = 400 + W*W
+    if node.children is not None:
+        size += 1200 + 200 * len(node.children)
+        if node.candidates:
+            size += 130 * len(node.candidates)
+    return size
+
+
+def prune_tree(tree, max_memory=MAX_TREE_MEMORY):
+    """ Bound the memory used by the tree: prune the subtrees of the least
+    visited nodes until the estimated memory of its nodes (node_memory())
+    is at most max_memory bytes, and drop nodes that are not part of it
+    anymore (e.g. the siblings of a new game tree root) from the
+    transposition table """
+    nodes = tree_nodes(tree)
+    memory = sum(node_memory(node) for node in nodes)
+    if memory > max_memory:
+        # Children have no more visits than their parents, so going
+        # from the least visited nodes prunes the deepest subtrees first
+        for node in sorted([n for n in nodes if n.children is not None and n is not tree], key=lambda n: n.v):
+            if memory <= max_memory:
+                break
+            memory -= sum(node_memory(child) for child in node.children if child is not None)
+            memory -= node_memory(node)
+            node.prune()
+            memory += node_memory(node)
+        nodes = tree_nodes(tree)
+    if transpositions is not None:
+        transpositions.retain(nodes)
+
+
 worker_pool = None
 
-def tree_search(tree, n, owner_map, disp=False):
-    """ Perform MCTS search from a given position for a given #iterations """
-    # Initialize root node
+def close_worker_pool():
+    """ stop the worker processes, e.g. after a board size change; the
+    next tree_search() starts new ones """
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.terminate()
+        worker_pool = None
+
+def mcplayout_batch(jobs, disp=False, phases=(), engine='python'):
+    """ run mcplayout() for each of the (pos, amaf_map) jobs (or all of
+    them in batch_playouts() with the 'numpy' engine), returning a list of
+    the results and the profile_stats of the given phases collected
+    meanwhile; used to amortize the per-task overhead of the worker pool
+    over several playouts """
+    if list(phases) != profile_phases:
+        set_profiling(phases)
+    profile_stats.clear()
+    if engine == 'numpy':
+        scores, amaf_maps, owners = batch_playouts([pos for pos, _ in jobs], [amaf_map for _, amaf_map in jobs])
+        return list(zip(scores.tolist(), amaf_maps, owners)), dict(profile_stats)
+    results = [mcplayout(pos, amaf_map, disp) for pos, amaf_map in jobs]
+    if np is not None:
+        # Send the amaf maps back in the compact form tree_update() works on
+        results = [(score, np.array(amaf_map, dtype=np.int8), owners) for score, amaf_map, owners in results]
+    return results, dict(profile_stats)
+
+
+def owner_counts():
+    """ return a zeroed array for add_owners() """
+    return np.zeros(W*W, dtype=int) if np is not None else W*W*[0]
+
+
+def add_owners(counts, owners):
+    """ add 1 for black and -1 for white owned points in the owners array
+    of a playout (see Position.owners()) to the counts """
+    if np is not None:
+        owners = np.frombuffer(owners, dtype=np.uint8)
+        counts += owners == BLACK
+        counts -= owners == WHITE
+        return
+    for c in range(W*W):
+        counts[c] += 1 if owners[c] == BLACK else -1 if owners[c] == WHITE else 0
+
+
+def search_decided(tree, n, i, elapsed, time_limit=None):
+    """ Whether the search of tree can stop as its best move cannot change
+    anymore; i playouts of n were issued in the elapsed time, and with
+    time_limit (in seconds) we also consider how many more we can do """
+    remaining = n - i
+    if time_limit is not None:
+        if elapsed >= time_limit:
+            return True
+        if i > 0:
+            remaining = min(remaining, i / elapsed * (time_limit - elapsed))
+    # The runner-up cannot overtake the most visited move even if it got
+    # all the remaining playouts
+    visits = sorted(tree.cv)
+    return len(visits) < 2 or visits[-1] - visits[-2] > remaining
+
+
+def tree_search(tree, n, owner_map, disp=False, batch=PLAYOUT_BATCH, stop=None, time_limit=None):
+    """ Perform MCTS search from a given position for a given #iterations
+    and optionally at most time_limit seconds, returning the index of the
+    best move among tree children; batch is the number of playouts sent
+    to a worker process at once; stop is an optional function telling
+    when to stop the search early (it then also replaces the other early
+    stop tests) """
+    if SEARCH_MODE == 'shared' and not disp:
+        return tree_search_shared(tree, n, owner_map, stop, time_limit)
+
+    # Initialize root node; all its moves are open to selection, the root
+    # getting all the playouts anyway
     if tree.children is None:
         tree.expand()
+    tree.widen()
 
     # We could simply run tree_descend(), mcplayout(), tree_update()
     # sequentially in a loop.  This is essentially what the code below
@@ -849,66 +2193,428 @@ def tree_search(tree, n, owner_map, disp=False):
     # multiprocessing Python module.  mcplayout() consumes maybe more than
     # 90% CPU, especially on larger boards.  (Except that with large patterns,
     # expand() in the tree descent phase may be quite expensive - we can tune
-    # that tradeoff by adjusting the EXPAND_VISITS constant.)
+    # that tradeoff by adjusting the (LAZY_)EXPAND_VISITS constants.)  To keep the
+    # inter-process communication overhead low, we send the leaves to the
+    # workers in batches, and get the finished batches back through a queue.
 
     n_workers = multiprocessing.cpu_count() if not disp else 1  # set to 1 when debugging
+    engine = PLAYOUT_ENGINE if np is not None and not disp else 'python'
+    if disp:
+        batch = 1
+    elif engine == 'numpy':
+        batch = max(batch, NUMPY_PLAYOUT_BATCH)
     global worker_pool
     if worker_pool is None:
-        worker_pool = Pool(processes=n_workers)
-    outgoing = []  # positions waiting for a playout
-    incoming = []  # positions that finished evaluation
-    ongoing = []  # currently ongoing playout jobs
-    i = 0
-    while i < n:
-        if not outgoing and not (disp and ongoing):
-            # Descend the tree so that we have something ready when a worker
-            # stops being busy
-            amaf_map = W*W*[0]
-            nodes = tree_descend(tree, amaf_map, disp=disp)
-            outgoing.append((nodes, amaf_map))
-
-        if len(ongoing) >= n_workers:
-            # Too many playouts running? Wait a bit...
-            ongoing[0][0].wait(0.01 / n_workers)
-        else:
+        worker_pool = Pool(processes=n_workers, initializer=init_worker, initargs=(patterns_state(),))
+    finished = queue.Queue()  # (nodes list, results list) of finished batches
+    ongoing = 0  # number of batches currently being played out
+    issued = 0  # number of playouts issued
+    i = 0  # number of playouts stored in the tree
+    owner_sum = owner_counts()
+    stopped = stop is not None and stop()
+    t_start = time.time()
+    while True:
+        # Keep all the workers busy, descending the tree for a batch of
+        # leaves for each idle one
+        while ongoing < n_workers and issued < n and not stopped:
+            jobs = []
+            for k in range(min(batch, n - issued)):
+                amaf_map = W*W*[0]
+                nodes, indices = tree_descend(tree, amaf_map, disp=disp)
+                jobs.append((nodes, indices, amaf_map))
+            worker_pool.apply_async(mcplayout_batch, ([(nodes[-1].pos, amaf_map) for nodes, _, amaf_map in jobs], disp,
+                                                      profile_phases, engine),
+                                    callback=lambda results, jobs=jobs: finished.put((jobs, results)),
+                                    error_callback=lambda e, jobs=jobs: finished.put((jobs, e)))
+            ongoing += 1
+            issued += len(jobs)
+        if not ongoing:
+            break
+
+        # Wait for some batch to finish and store its results in the tree
+        t_wait = time.time()
+        jobs, results = finished.get()
+        ongoing -= 1
+        if isinstance(results, Exception):
+            raise results
+        results, stats = results
+        if profile_phases:
+            profile_add(stats)
+            profile_add({'ipc_wait': [1, time.time() - t_wait]})
+        for (nodes, indices, _), (score, amaf_map, owners) in zip(jobs, results):
+            tree_update(nodes, indices, amaf_map, score, disp=disp)
+            add_owners(owner_sum, owners)
             i += 1
-            if i > 0 and i % REPORT_PERIOD == 0:
+            if i % REPORT_PERIOD == 0:
                 print_tree_summary(tree, i, f=sys.stderr)
 
-            # Issue an mcplayout job to the worker pool
-            nodes, amaf_map = outgoing.pop()
-            ongoing.append((worker_pool.apply_async(mcplayout, (nodes[-1].pos, amaf_map, disp)), nodes))
+        # Early stop test
+        if stop is not None:
+            stopped = stop()
+        else:
+            best_wr = tree.winrate(tree.best_move())
+            if i > n*0.05 and best_wr > FASTPLAY5_THRES or i > n*0.2 and best_wr > FASTPLAY20_THRES:
+                stopped = True
+            elif search_decided(tree, n, issued, time.time() - t_start, time_limit):
+                stopped = True
 
-        # Anything to store in the tree?  (We do this step out-of-order
-        # picking up data from the previous round so that we don't stall
-        # ready workers while we update the tree.)
-        while incoming:
-            score, amaf_map, owner_map_one, nodes = incoming.pop()
-            tree_update(nodes, amaf_map, score, disp=disp)
-            for c in range(W*W):
-                owner_map[c] += owner_map_one[c]
+    for c in range(W*W):
+        owner_map[c] = float(owner_map[c] + owner_sum[c]) / max(i, 1)
+    dump_subtree(tree)
+    print_tree_summary(tree, i, f=sys.stderr)
+    print_search_speed(i, time.time() - t_start, n_workers, f=sys.stderr)
+    return tree.best_move()
 
-        # Any playouts are finished yet?
-        for job, nodes in ongoing:
-            if not job.ready():
-                continue
-            # Yes! Queue them up for storing in the tree.
-            score, amaf_map, owner_map_one = job.get()
-            incoming.append((score, amaf_map, owner_map_one, nodes))
-            ongoing.remove((job, nodes))
 
-        # Early stop test
-        best_wr = tree.best_move().winrate()
-        if i > n*0.05 and best_wr > FASTPLAY5_THRES or i > n*0.2 and best_wr > FASTPLAY20_THRES:
-            break
+# Tree-parallel search: instead of sending positions to a process pool
+# for playouts, the worker processes run the whole descend + playout +
+# update loop themselves, against a tree whose statistics live in
+# shared memory.  Updates are done without locking - an occassional lost
+# update does not really matter, and the virtual loss applied while
+# descending spreads the workers over different parts of the tree.
+# Only expansion (allocating the children nodes) takes a lock.
+
+class SharedTree():
+    """ Search tree laid out in flat arrays in shared memory, where node 0
+    is the root and the children of node i are the nodes child[i] ..
+    child[i]+nchildren[i]-1; move is the coordinate of the move leading
+    to the node (0 for pass), the rest are statistics of that move as in
+    TreeNode arrays """
+    __slots__ = ['size', 'move', 'v', 'w', 'pv', 'pw', 'av', 'aw', 'child', 'nchildren',
+                 'n_nodes', 'playouts', 'stop', 'lock']
+
+    def __init__(self, size):
+        self.size = size
+        self.move = RawArray('i', size)
+        self.v = RawArray('i', size)
+        self.w = RawArray('i', size)
+        self.pv = RawArray('d', size)
+        self.pw = RawArray('d', size)
+        self.av = RawArray('i', size)
+        self.aw = RawArray('i', size)
+        self.child = RawArray('i', size)
+        self.nchildren = RawArray('i', size)  # 0 for leaf nodes, -1 while being expanded
+        self.n_nodes = RawValue('i', 0)
+        self.playouts = RawValue('i', 0)  # playouts started so far
+        self.stop = RawValue('i', 0)  # set to stop the workers early
+        self.lock = multiprocessing.Lock()
+
+    def load(self, tree):
+        """ reset the shared tree to a copy of the given TreeNode tree """
+        self.move[0] = 0
+        self.v[0], self.w[0] = tree.v, 0
+        self.pv[0] = self.pw[0] = self.av[0] = self.aw[0] = 0
+        self.nchildren[0] = 0
+        n_nodes = 1
+        fringe = [(tree, 0)]
+        while fringe:
+            node, i = fringe.pop()
+            if node is None or node.children is None or n_nodes + len(node.children) > self.size:
+                continue
+            self.child[i] = n_nodes
+            self.nchildren[i] = len(node.children)
+            for j, child in enumerate(node.children):
+                self.move[n_nodes] = node.moves[j] if node.moves[j] is not None else 0
+                self.v[n_nodes], self.w[n_nodes] = int(node.cv[j]), int(node.cw[j])
+                self.pv[n_nodes], self.pw[n_nodes] = node.cpv[j], node.cpw[j]
+                self.av[n_nodes], self.aw[n_nodes] = int(node.cav[j]), int(node.caw[j])
+                self.nchildren[n_nodes] = 0
+                fringe.append((child, n_nodes))
+                n_nodes += 1
+        self.n_nodes.value = n_nodes
+        self.playouts.value = 0
+        self.stop.value = 0
+
+    def store(self, node, i=0, depth=SHARED_IMPORT_DEPTH, recurse=True):
+        """ copy statistics of shared tree node i back to the TreeNode node;
+        with recurse, continue with its subtree, creating TreeNode children
+        for nodes expanded in the shared tree up to the given depth (which
+        means making a new Position for each) """
+        start, n_children = self.child[i], self.nchildren[i]
+        moves = [self.move[j] or None for j in range(start, start + n_children)]
+        # A child created on demand may be a node of the transposition
+        # table that was expanded (differently) in the game tree, while
+        # load() passed it as a leaf; keep its own statistics then
+        if node.children is not None and n_children > 0 and node.moves != moves:
+            return
+        node.v = self.v[i]
+        if n_children <= 0:
+            return
+        if node.children is None:
+            if depth <= 0:
+                return
+            node.set_children([None] * n_children, moves,
+                              self.pv[start:start + n_children], self.pw[start:start + n_children])
+        for k, j in enumerate(range(start, start + n_children)):
+            node.cv[k], node.cw[k] = self.v[j], self.w[j]
+            node.cav[k], node.caw[k] = self.av[j], self.aw[j]
+            # Children not expanded in the shared tree are created on demand
+            if recurse and (node.children[k] is not None or self.nchildren[j] > 0):
+                self.store(node.child(k), j, depth - 1)
+
+    def urgency(self, i):
+        return rave_urgency(self.v[i], self.w[i], self.pv[i], self.pw[i], self.av[i], self.aw[i])
+
+    def expand(self, i, pos, history):
+        """ add and initialize children to leaf node i with position pos,
+        unless another worker is already expanding it """
+        with self.lock:
+            if self.nchildren[i] != 0:
+                return
+            self.nchildren[i] = -1
+        moves = [(c, pv, pw) for c, pos2, pv, pw in expand_moves(pos, history)]
+        if not moves:
+            # No possible moves, add a pass move
+            moves = [(0, PRIOR_EVEN, PRIOR_EVEN/2)]
+        with self.lock:
+            start = self.n_nodes.value
+            if start + len(moves) > self.size:
+                return  # out of memory, node stays a leaf for good
+            self.n_nodes.value = start + len(moves)
+        for j, (c, pv, pw) in enumerate(moves, start):
+            self.move[j] = c
+            self.v[j] = self.w[j] = self.av[j] = self.aw[j] = 0
+            self.pv[j], self.pw[j] = pv, pw
+            self.nchildren[j] = 0
+        # Publish the children only once they are initialized
+        self.child[i] = start
+        self.nchildren[i] = len(moves)
+
+    def descend(self, pos, amaf_map):
+        """ descend through the tree to a leaf, playing the moves on the way
+        in pos; return the list of nodes visited, like tree_descend() """
+        history = set(pos.history)
+        history.add(pos.hash)
+        self.v[0] += 1
+        nodes = [0]
+        passes = 0
+        while self.nchildren[nodes[-1]] > 0 and passes < 2:
+            # Pick the most urgent child
+            start = self.child[nodes[-1]]
+            children = list(range(start, start + self.nchildren[nodes[-1]]))
+            random.shuffle(children)  # randomize the max in case of equal urgency
+            i = max(children, key=self.urgency)
+            nodes.append(i)
+
+            move = self.move[i]
+            if not move:
+                passes += 1
+                pos.play(None)
+            else:
+                passes = 0
+                if amaf_map[move] == 0:  # Mark the coordinate with 1 for black
+                    amaf_map[move] = 1 if pos.n % 2 == 0 else -1
+                pos.play(move)
+            history.add(pos.hash)
+
+            # updating visits on the way *down* represents "virtual loss"
+            self.v[i] += 1
+            if self.nchildren[i] == 0 and self.v[i] >= EXPAND_VISITS:
+                self.expand(i, pos, history)
+
+        return nodes
+
+    def update(self, nodes, n, amaf_map, score):
+        """ store simulation result in the tree (@nodes is the tree path
+        starting at a position with move number n), like tree_update() """
+        if np is not None:
+            amaf = np.asarray(amaf_map)
+            move, av, aw = [np.frombuffer(a, dtype=np.intc) for a in (self.move, self.av, self.aw)]
+        for depth in range(len(nodes)-1, -1, -1):
+            i = nodes[depth]
+            self.w[i] += score < 0  # score is for to-play, node statistics for just-played
+            # Update the node children AMAF stats with moves we made
+            # with their color
+            amaf_map_value = 1 if (n + depth) % 2 == 0 else -1
+            if self.nchildren[i] > 0 and np is not None:
+                start = self.child[i]
+                end = start + self.nchildren[i]
+                played = amaf[move[start:end]] == amaf_map_value
+                av[start:end] += played
+                if score > 0:  # reversed perspective
+                    aw[start:end] += played
+            elif self.nchildren[i] > 0:
+                start = self.child[i]
+                for j in range(start, start + self.nchildren[i]):
+                    move = self.move[j]
+                    if move and amaf_map[move] == amaf_map_value:
+                        self.aw[j] += score > 0  # reversed perspective
+                        self.av[j] += 1
+            score = -score
+
+
+def shared_tree_worker(stree, pos, n, results, patterns, phases):
+    """ worker process of the tree-parallel search, running playouts from
+    the root position pos until n of them were started in total; the
+    owner map sum, number of playouts done and profile_stats of the given
+    phases are put to the results queue; patterns are as returned by
+    patterns_state() """
+    init_worker(patterns)
+    if list(phases) != profile_phases:
+        set_profiling(phases)
+    profile_stats.clear()
+    random.seed()  # do not repeat the playouts of the other workers
+    owner_sum = owner_counts()
+    i = 0
+    while True:
+        with stree.lock:
+            if stree.playouts.value >= n or stree.stop.value:
+                break
+            stree.playouts.value += 1
+        amaf_map = W*W*[0]
+        pos2 = pos.copy()
+        nodes = stree.descend(pos2, amaf_map)
+        score, amaf_map, owners = mcplayout(pos2, amaf_map)
+        stree.update(nodes, pos.n, amaf_map, score)
+        add_owners(owner_sum, owners)
+        i += 1
+    results.put((owner_sum, i, dict(profile_stats)))
+
+
+shared_tree = None
+
+def tree_search_shared(tree, n, owner_map, stop=None, time_limit=None):
+    """ Perform tree-parallel MCTS search from a given position for a given
+    #iterations, with one worker process per CPU; returns the index of
+    the best move and uses stop and time_limit like tree_search() """
+    # Initialize root node; all its moves are open to selection, the root
+    # getting all the playouts anyway
+    if tree.children is None:
+        tree.expand()
+    tree.widen()
+
+    global shared_tree
+    if shared_tree is None:
+        shared_tree = SharedTree(SHARED_TREE_SIZE)
+    shared_tree.load(tree)
+
+    t_start = time.time()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=shared_tree_worker, args=(shared_tree, tree.pos, n, results, patterns_state(),
+                                                                          profile_phases))
+               for j in range(multiprocessing.cpu_count())]
+    for worker in workers:
+        worker.start()
+
+    # Just watch the progress, reporting and testing for early stop,
+    # collecting the results of the workers as they finish (they cannot
+    # exit before their results are taken off the queue)
+    i = 0
+    reported = 0
+    n_reports = 0
+    i_done = 0
+    while n_reports < len(workers):
+        try:
+            owner_sum, i_one, stats = results.get(timeout=0.05)
+            profile_add(stats)
+            for c in range(W*W):
+                owner_map[c] += owner_sum[c]
+            i_done += i_one
+            n_reports += 1
+            continue
+        except queue.Empty:
+            pass
+        if shared_tree.stop.value:
+            continue
+        shared_tree.store(tree, recurse=False)
+        i = shared_tree.playouts.value
+        if i // REPORT_PERIOD > reported // REPORT_PERIOD:
+            print_tree_summary(tree, i, f=sys.stderr)
+            reported = i
+        if stop is not None:
+            shared_tree.stop.value = int(stop())
+        else:
+            best_wr = tree.winrate(tree.best_move())
+            if i > n*0.05 and best_wr > FASTPLAY5_THRES or i > n*0.2 and best_wr > FASTPLAY20_THRES:
+                shared_tree.stop.value = 1
+            elif search_decided(tree, n, i, time.time() - t_start, time_limit):
+                shared_tree.stop.value = 1
+    for worker in workers:
+        worker.join()
+    i = i_done
+    shared_tree.store(tree)
 
     for c in range(W*W):
-        owner_map[c] = float(owner_map[c]) / i
+        owner_map[c] = float(owner_map[c]) / max(i, 1)
     dump_subtree(tree)
     print_tree_summary(tree, i, f=sys.stderr)
+    print_search_speed(i, time.time() - t_start, len(workers), f=sys.stderr)
     return tree.best_move()
 
 
+#################
+# instrumentation
+
+# When profiling, the number of calls and the time spent in the phases
+# of the search are collected in profile_stats (phase -> [calls, seconds]),
+# including those in the worker processes, which send them along with
+# their results.  The phases are timed by replacing the functions doing
+# them by timing wrappers, so profiling costs nothing while off.  The time
+# of a phase includes the phases it calls (e.g. descend includes expand),
+# recursive calls are counted but not timed again.  ipc_wait is the time
+# tree_search() waits for the results of the worker pool.
+PROFILE_PHASES = [('descend', 'tree_descend'), ('descend', 'SharedTree.descend'),
+                  ('expand', 'TreeNode.expand'), ('expand', 'TreeNode.widen'), ('expand', 'TreeNode.make_child'),
+                  ('expand', 'SharedTree.expand'),
+                  ('playout', 'mcplayout'), ('playout', 'batch_playouts'), ('fix_atari', 'fix_atari'),
+                  ('large_pattern', 'large_pattern_probability'),
+                  ('update', 'tree_update'), ('update', 'SharedTree.update')]
+profile_stats = dict()
+profile_phases = []  # the phases being profiled
+profile_originals = dict()  # function name -> the function replaced by a timing wrapper
+profile_running = set()  # phases being timed, not to count the time of nested calls twice
+
+def profile_add(stats):
+    """ add the calls and times of stats to profile_stats """
+    for phase, (calls, seconds) in stats.items():
+        total = profile_stats.setdefault(phase, [0, 0.])
+        total[0] += calls
+        total[1] += seconds
+
+
+def profiled(phase, f):
+    """ return a wrapper of f adding its calls and time to profile_stats
+    of phase """
+    def wrapper(*args, **kwargs):
+        stats = profile_stats.setdefault(phase, [0, 0.])
+        stats[0] += 1
+        if phase in profile_running:
+            return f(*args, **kwargs)
+        profile_running.add(phase)
+        t0 = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            stats[1] += time.time() - t0
+            profile_running.discard(phase)
+    return wrapper
+
+
+def set_profiling(phases):
+    """ profile the given phases (of PROFILE_PHASES), or nothing if empty """
+    global profile_phases
+    profile_phases = [phase for phase in dict(PROFILE_PHASES) if phase in phases]
+    for phase, name in PROFILE_PHASES:
+        classname, _, attr = name.rpartition('.')
+        owner = globals()[classname] if classname else sys.modules[__name__]
+        if name not in profile_originals:
+            profile_originals[name] = getattr(owner, attr)
+        f = profile_originals[name]
+        setattr(owner, attr, profiled(phase, f) if phase in profile_phases else f)
+
+
+def profile_report(since=None):
+    """ return profile_stats (less those of an earlier copy since) as lines
+    of phase, calls, total and per call time, the most time first """
+    lines = []
+    for phase, (calls, seconds) in sorted(profile_stats.items(), key=lambda s: -s[1][1]):
+        if since is not None and phase in since:
+            calls, seconds = calls - since[phase][0], seconds - since[phase][1]
+        if calls > 0:
+            lines.append('%-13s %9d calls %9.3fs %10.1fus/call' % (phase, calls, seconds, 1e6 * seconds / calls))
+    return '\n'.join(lines)
+
+
 ###################
 # user interface(s)
 
@@ -918,11 +2624,10 @@ def print_pos(pos, f=sys.stderr, owner_map=None):
     """ print visualization of the given board position, optionally also
     including an owner map statistic (probability of that area of board
     eventually becoming black/white) """
+    board = board_str(pos.board)
     if pos.n % 2 == 0:  # to-play is black
-        board = pos.board.replace('x', 'O')
         Xcap, Ocap = pos.cap
     else:  # to-play is white
-        board = pos.board.replace('X', 'O').replace('x', 'X')
         Ocap, Xcap = pos.cap
     print('Move: %-3d   Black: %d caps   White: %d caps  Komi: %.1f' % (pos.n, Xcap, Ocap, pos.komi), file=f)
     pretty_board = ' '.join(board.rstrip()) + ' '
@@ -952,30 +2657,75 @@ def print_pos(pos, f=sys.stderr, owner_map=None):
     print('', file=f)
 
 
-def dump_subtree(node, thres=N_SIMS/50, indent=0, f=sys.stderr, recurse=True):
-    """ print this node and all its children with v >= thres. """
+def dump_move(node, i, indent=0, f=sys.stderr):
+    """ print the statistics of the i-th move from this node. """
     print("%s+- %s %.3f (%d/%d, prior %d/%d, rave %d/%d=%.3f, urgency %.3f)" %
-          (indent*' ', str_coord(node.pos.last), node.winrate(),
-           node.w, node.v, node.pw, node.pv, node.aw, node.av,
-           float(node.aw)/node.av if node.av > 0 else float('nan'),
-           node.rave_urgency()), file=f)
-    if not recurse:
+          (indent*' ', str_coord(node.moves[i]), node.winrate(i),
+           node.cw[i], node.cv[i], node.cpw[i], node.cpv[i], node.caw[i], node.cav[i],
+           float(node.caw[i])/node.cav[i] if node.cav[i] > 0 else float('nan'),
+           node.rave_urgency(i)), file=f)
+
+
+def dump_subtree(node, thres=N_SIMS/50, indent=0, f=sys.stderr):
+    """ print all the moves from this node with v >= thres, and their subtrees. """
+    if node.children is None:
         return
-    for child in sorted(node.children, key=lambda n: n.v, reverse=True):
-        if child.v >= thres:
-            dump_subtree(child, thres=thres, indent=indent+3, f=f)
+    for i in sorted(range(len(node.children)), key=lambda i: node.cv[i], reverse=True):
+        if node.cv[i] >= thres:
+            dump_move(node, i, indent=indent, f=f)
+            dump_subtree(node.child(i), thres=thres, indent=indent+3, f=f)
 
 
 def print_tree_summary(tree, sims, f=sys.stderr):
-    best_nodes = sorted(tree.children, key=lambda n: n.v, reverse=True)[:5]
+    best_moves = sorted(range(len(tree.children)), key=lambda i: tree.cv[i], reverse=True)[:5]
     best_seq = []
     node = tree
-    while node is not None:
-        best_seq.append(node.pos.last)
-        node = node.best_move()
+    while node.children is not None and len(best_seq) < 5:
+        i = node.best_move()
+        best_seq.append(node.moves[i])
+        node = node.child(i)
     print('[%4d] winrate %.3f | seq %s | can %s' %
-          (sims, best_nodes[0].winrate(), ' '.join([str_coord(c) for c in best_seq[1:6]]),
-           ' '.join(['%s(%.3f)' % (str_coord(n.pos.last), n.winrate()) for n in best_nodes])), file=f)
+          (sims, tree.winrate(best_moves[0]), ' '.join([str_coord(c) for c in best_seq]),
+           ' '.join(['%s(%.3f)' % (str_coord(tree.moves[i]), tree.winrate(i)) for i in best_moves])), file=f)
+
+
+def print_search_speed(sims, t, n_workers, f=sys.stderr):
+    print('%d playouts in %.3fs with %d workers: %.1f playouts/s, %.1f playouts/worker/s' %
+          (sims, t, n_workers, sims / t, sims / (t * n_workers)), file=f)
+
+
+def tree_advance(tree, node):
+    """ make node (a child of tree, or a new node following it) the new
+    game tree root, recording the position of tree in the game history;
+    the rest of the old tree is released """
+    node.pos.history = tree.pos.history | {tree.pos.hash}
+    prune_tree(node)
+    return node
+
+
+def tree_play(tree, c):
+    """ advance the game tree by move c (None for pass), reusing the node
+    searched already - either a child of tree, or the same position reached
+    by a different move order - if there is one """
+    if tree.children is not None and c in tree.moves:
+        return tree_advance(tree, tree.child(tree.moves.index(c)))
+    pos2 = tree.pos.move(c) if c is not None else tree.pos.pass_move()
+    node = transpositions.get(pos2) if transpositions is not None else None
+    return tree_advance(tree, node if node is not None else TreeNode(pos=pos2))
+
+
+def time_budget(n, time_left, stones, byoyomi_time, byoyomi_stones):
+    """ wall-clock time to spend on move n when we have time_left seconds
+    for the given number of stones (0 in main time) as in GTP time_left,
+    with the given byo-yomi settings """
+    if stones > 0:
+        budget = float(time_left) / stones
+    else:
+        budget = float(time_left) / max(TIME_MOVES_LEFT_MIN, (N*N - n) / 2)
+        if byoyomi_stones > 0:
+            # Running out of main time is fine, byo-yomi will follow
+            budget += float(byoyomi_time) / byoyomi_stones
+    return max(budget - TIME_MARGIN, 0.1)
 
 
 def parse_coord(s):
@@ -1001,6 +2751,122 @@ def mcbenchmark(n):
     return float(sumscore) / n
 
 
+# Midgame positions of the benchmark, as (board size, moves from the empty
+# board); the moves are played out with a fixed seed for each workload
+BENCHMARK_POSITIONS = [
+    (9, 'B5 G3 C5 B2 F8 B6 C6 C7 D7 D6 E6 D5 E5 D4 E4 E3 D3 C4 J5 B4 A4 A5 A3 A2'),
+    (13, 'B12 C7 F11 M6 C4 M12 D3 C12 C11 D12 D11 E12 F12 E11 E10 F10 F9 G10 G11 H10 H11 J11 J10 K10 J9 K9 K8 '
+         'L8 K7 L7 K6 D10 E9 D9 C10 C9 B9 B10 B11 A11 A10 H6 A12 B13 C13 D13 B4 G9 G8 F8'),
+    (19, 'M4 N15 B18 C18 C17 D18 D17 E18 E17 F18 F17 G17 G18 H18 H17 G16 F16 F15 G15 H16 J17 B9 J18 E14 K18 L18 '
+         'L17 M18 M17 N18 N17 O18 O17 P17 P18 Q18 Q17 P16 Q16 P15 Q15 Q14 P14 P13 O14 O13 N13 N14 M13 O15 M14 '
+         'M15 L15 L14 L13 K13 K14 J14 J13 K12 J12 J11 P11 H11 H12 G11 G12 F11 F12 E12 E11 E10 D11 D10 K17 C10 '
+         'C11 B11 B12 A12 B13 C12 C13 D12 F3 Q8 P9 P8 O9 O8'),
+]
+BENCHMARK_SEED = 1
+BENCHMARK_PLAYOUTS = 100  # playouts from each position
+BENCHMARK_MOVES = 2  # moves searched and played from each position
+BENCHMARK_SIMS = 200  # playouts of each searched move
+
+def benchmark_position(size, moves):
+    """ switch to the given board size and return the position after
+    the given moves """
+    set_board_size(size)
+    pos = empty_position()
+    for s in moves.split():
+        pos = pos.move(parse_coord(s))
+    return pos
+
+
+def benchmark_search(tree, n, timings):
+    """ serial tree search of n playouts as done by tree_search(), adding
+    the time spent in each of its phases to timings """
+    for i in range(n):
+        amaf_map = W*W*[0]
+        t0 = time.time()
+        nodes, indices = tree_descend(tree, amaf_map)
+        t1 = time.time()
+        score, amaf_map, owners = mcplayout(nodes[-1].pos, amaf_map)
+        t2 = time.time()
+        tree_update(nodes, indices, amaf_map, score)
+        t3 = time.time()
+        timings['descend'] += t1 - t0
+        timings['playout'] += t2 - t1
+        timings['update'] += t3 - t2
+    return tree.best_move()
+
+
+def benchmark(baseline=None):
+    """ run the benchmark workloads in a single process with fixed seeds,
+    returning the results as a dict; with baseline results of an earlier
+    run, the speedups against it are included """
+    # Expansion happens during tree_descend(); its time is measured
+    # separately by profiling it
+    timings = dict()
+    phases0 = profile_phases
+    results = dict(seed=BENCHMARK_SEED, playouts=BENCHMARK_PLAYOUTS, moves=BENCHMARK_MOVES,
+                   sims=BENCHMARK_SIMS, positions=[])
+    size0 = N
+    set_profiling(['expand'])
+    try:
+        for size, moves in BENCHMARK_POSITIONS:
+            pos = benchmark_position(size, moves)
+            if transpositions is not None:
+                transpositions.clear()
+            ladder_memo.clear()
+
+            random.seed(BENCHMARK_SEED)
+            t0 = time.time()
+            for i in range(BENCHMARK_PLAYOUTS):
+                mcplayout(pos, W*W*[0])
+            playout_time = time.time() - t0
+            if np is not None:
+                random.seed(BENCHMARK_SEED)
+                t0 = time.time()
+                batch_playouts(BENCHMARK_PLAYOUTS * [pos], BENCHMARK_PLAYOUTS * [W*W*[0]])
+                batch_playout_time = time.time() - t0
+
+            random.seed(BENCHMARK_SEED)
+            timings.update(descend=0, playout=0, update=0)
+            profile_stats.clear()
+            t0 = time.time()
+            tree = TreeNode(pos=pos)
+            played = []  # the same with the same seed, unless the search changed
+            for i in range(BENCHMARK_MOVES):
+                if tree.children is None:
+                    tree.expand()
+                tree.widen()
+                i = benchmark_search(tree, BENCHMARK_SIMS, timings)
+                played.append(str_coord(tree.moves[i]))
+                tree = tree_advance(tree, tree.child(i))
+            search_time = time.time() - t0
+            timings['expand'] = profile_stats['expand'][1] if 'expand' in profile_stats else 0
+            timings['descend'] -= timings['expand']
+
+            results['positions'].append(dict(
+                size=size, n=pos.n, played=played,
+                playouts_per_s=BENCHMARK_PLAYOUTS / playout_time,
+                moves_per_s=BENCHMARK_MOVES / search_time,
+                search_playouts_per_s=BENCHMARK_MOVES * BENCHMARK_SIMS / search_time,
+                phases=dict(timings)))
+            if np is not None:
+                results['positions'][-1]['batch_playouts_per_s'] = BENCHMARK_PLAYOUTS / batch_playout_time
+    finally:
+        set_profiling(phases0)
+        set_board_size(size0)
+
+    if resource is not None:
+        # kilobytes on Linux, bytes on OS X
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results['peak_rss_kb'] = maxrss // 1024 if sys.platform == 'darwin' else maxrss
+    if baseline is not None:
+        for result, base in zip(results['positions'], baseline['positions']):
+            result['speedup'] = dict((k, result[k] / base[k])
+                                     for k in ('playouts_per_s', 'batch_playouts_per_s', 'moves_per_s',
+                                               'search_playouts_per_s')
+                                     if k in result and k in base)
+    return results
+
+
 def game_io(computer_black=False):
     """ A simple minimalistic text mode UI. """
 
@@ -1019,56 +2885,89 @@ def game_io(computer_black=False):
                 continue
             if c is not None:
                 # Not a pass
-                if tree.pos.board[c] != '.':
+                if tree.pos.board[c] != EMPTY:
                     print('Bad move (not empty point)')
                     continue
 
-                # Find the next node in the game tree and proceed there
-                nodes = [n for n in tree.children if n.pos.last == c]
-                if not nodes:
+                # Not every legal move may be among the tree children with
+                # lazy expansion, so test the rules on the position
+                pos2 = tree.pos.move(c)
+                if pos2 is None or pos2.hash in tree.pos.history | {tree.pos.hash}:
                     print('Bad move (rule violation)')
                     continue
-                tree = nodes[0]
+                # Find the next node in the game tree and proceed there
+                tree = tree_play(tree, c)
 
             else:
                 # Pass move
-                if tree.children[0].pos.last is None:
-                    tree = tree.children[0]
-                else:
-                    tree = TreeNode(pos=tree.pos.pass_move())
+                tree = tree_play(tree, None)
 
             print_pos(tree.pos)
 
         owner_map = W*W*[0]
-        tree = tree_search(tree, N_SIMS, owner_map)
+        i = tree_search(tree, N_SIMS, owner_map)
+        winrate = tree.winrate(i)
+        tree = tree_advance(tree, tree.child(i))
         if tree.pos.last is None and tree.pos.last2 is None:
             score = tree.pos.score()
             if tree.pos.n % 2:
                 score = -score
             print('Game over, score: B%+.1f' % (score,))
             break
-        if float(tree.w)/tree.v < RESIGN_THRES:
+        if winrate < RESIGN_THRES:
             print('I resign.')
             break
     print('Thank you for the game!')
 
 
-def gtp_io():
-    """ GTP interface for our program.  We can play only on the board size
-    which is configured (N), and we ignore color information and assume
-    alternating play! """
+def read_commands(commands):
+    """ put the lines read from stdin to the commands queue, then None;
+    we read the file descriptor directly as a thread blocked inside
+    sys.stdin would hold its lock, deadlocking processes forked meanwhile
+    as they close their sys.stdin """
+    data = b''
+    while True:
+        chunk = os.read(sys.stdin.fileno(), 4096)
+        if not chunk:
+            break
+        data += chunk
+        while b'\n' in data:
+            line, data = data.split(b'\n', 1)
+            commands.put(line.decode())
+    if data:
+        commands.put(data.decode())
+    commands.put(None)
+
+
+def gtp_io(ponder=PONDER):
+    """ GTP interface for our program.  We ignore color information and
+    assume alternating play!  With ponder, we keep searching the current position
+    while waiting for the next command. """
     known_commands = ['boardsize', 'clear_board', 'komi', 'play', 'genmove',
                       'final_score', 'quit', 'name', 'version', 'known_command',
-                      'list_commands', 'protocol_version', 'tsdebug']
+                      'list_commands', 'protocol_version', 'tsdebug',
+                      'time_settings', 'time_left', 'michi-profile']
 
     tree = TreeNode(pos=empty_position())
     tree.expand()
+    byoyomi = None  # (byo-yomi time, stones) with time control, None for no time limits
+    time_left = {}  # color -> (seconds, stones) as in GTP time_left
+
+    # Commands are read in a separate thread so that we can search until
+    # the next one arrives
+    commands = queue.Queue()
+    reader = threading.Thread(target=read_commands, args=(commands,))
+    reader.daemon = True
+    reader.start()
 
     while True:
-        try:
-            line = input().strip()
-        except EOFError:
+        while ponder and commands.empty() and not (tree.pos.last is None and tree.pos.last2 is None and tree.pos.n > 0):
+            tree_search(tree, N_SIMS, W*W*[0], stop=lambda: not commands.empty())
+            prune_tree(tree)
+        line = commands.get()
+        if line is None:
             break
+        line = line.strip()
         if line == '':
             continue
         command = [s.lower() for s in line.split()]
@@ -1080,41 +2979,84 @@ def gtp_io():
         owner_map = W*W*[0]
         ret = ''
         if command[0] == "boardsize":
-            if int(command[1]) != N:
-                print("Warning: Trying to set incompatible boardsize %s (!= %d)" % (command[1], N), file=sys.stderr)
+            size = int(command[1])
+            if 1 < size <= len(colstr):
+                if size != N:
+                    # The tables of a new size are computed once and kept
+                    # for switching back; the workers have to be restarted
+                    # to pick them up
+                    set_board_size(size)
+                    close_worker_pool()
+                    ladder_memo.clear()
+                if transpositions is not None:
+                    transpositions.clear()
+                tree = TreeNode(pos=empty_position())
+                tree.expand()
+                owner_map = W*W*[0]
+            else:
+                print("Warning: Trying to set unsupported boardsize %s" % (command[1],), file=sys.stderr)
                 ret = None
         elif command[0] == "clear_board":
+            if transpositions is not None:
+                transpositions.clear()
             tree = TreeNode(pos=empty_position())
             tree.expand()
         elif command[0] == "komi":
-            # XXX: can we do this nicer?!
-            tree.pos = Position(board=tree.pos.board, cap=(tree.pos.cap[0], tree.pos.cap[1]),
-                                n=tree.pos.n, ko=tree.pos.ko, last=tree.pos.last, last2=tree.pos.last2,
-                                komi=float(command[1]))
+            tree.pos.komi = float(command[1])
         elif command[0] == "play":
             c = parse_coord(command[2])
+            # Find the next node in the game tree and proceed there; it may
+            # be missing after several play commands in row, an eye-filling
+            # move, etc.
+            tree = tree_play(tree, c)
+        elif command[0] == "genmove":
+            color = command[1][0]
+            stats0 = dict((phase, list(stats)) for phase, stats in profile_stats.items())
+            c = book_move(tree.pos)
             if c is not None:
-                # Find the next node in the game tree and proceed there
-                if tree.children is not None and [n for n in tree.children if n.pos.last == c]:
-                    tree = [n for n in tree.children if n.pos.last == c][0]
-                else:
-                    # Several play commands in row, eye-filling move, etc.
-                    tree = TreeNode(pos=tree.pos.move(c))
-
+                # Opening played often enough already, answer right away
+                print('Playing book move %s' % (str_coord(c),), file=sys.stderr)
+                tree = tree_play(tree, c)
+                ret = str_coord(c)
             else:
-                # Pass move
-                if tree.children[0].pos.last is None:
-                    tree = tree.children[0]
+                snapshot = book_snapshot(tree)
+                if byoyomi is not None:
+                    t_start = time.time()
+                    i = tree_search(tree, sys.maxsize, owner_map,
+                                    time_limit=time_budget(tree.pos.n, *(time_left[color] + byoyomi)))
+                    # Keep our clock in case we do not get time_left
+                    seconds, stones = time_left[color]
+                    seconds -= time.time() - t_start
+                    if stones > 0:
+                        stones -= 1
+                        if stones == 0:
+                            seconds, stones = byoyomi
+                    elif seconds <= 0 and byoyomi[1] > 0:
+                        seconds, stones = byoyomi
+                    time_left[color] = (seconds, stones)
                 else:
-                    tree = TreeNode(pos=tree.pos.pass_move())
-        elif command[0] == "genmove":
-            tree = tree_search(tree, N_SIMS, owner_map)
-            if tree.pos.last is None:
-                ret = 'pass'
-            elif float(tree.w)/tree.v < RESIGN_THRES:
-                ret = 'resign'
+                    i = tree_search(tree, N_SIMS, owner_map)
+                winrate = tree.winrate(i)
+                if profile_phases:
+                    print(profile_report(since=stats0), file=sys.stderr)
+                book_record(tree, snapshot)
+                tree = tree_advance(tree, tree.child(i))
+                if tree.pos.last is None:
+                    ret = 'pass'
+                elif winrate < RESIGN_THRES:
+                    ret = 'resign'
+                else:
+                    ret = str_coord(tree.pos.last)
+        elif command[0] == "time_settings":
+            main_time, byoyomi_time, byoyomi_stones = float(command[1]), float(command[2]), int(command[3])
+            if byoyomi_time > 0 and byoyomi_stones == 0:
+                byoyomi = None  # no time limits
             else:
-                ret = str_coord(tree.pos.last)
+                byoyomi = (byoyomi_time, byoyomi_stones)
+                clock = (main_time, 0) if main_time > 0 else byoyomi
+                time_left = {'b': clock, 'w': clock}
+        elif command[0] == "time_left":
+            time_left[command[1][0]] = (float(command[2]), int(command[3]))
         elif command[0] == "final_score":
             score = tree.pos.score()
             if tree.pos.n % 2:
@@ -1125,12 +3067,22 @@ def gtp_io():
                 ret = 'B+%.1f' % (score,)
             elif score < 0:
                 ret = 'W+%.1f' % (-score,)
+        elif command[0] == "michi-profile":
+            # michi-profile [on [phase...] | off | reset]; reports the
+            # profile collected so far
+            if command[1:2] == ['on']:
+                set_profiling(command[2:] or dict(PROFILE_PHASES))
+            elif command[1:2] == ['off']:
+                set_profiling(())
+            elif command[1:2] == ['reset']:
+                profile_stats.clear()
+            ret = profile_report()
         elif command[0] == "name":
             ret = 'michi'
         elif command[0] == "version":
             ret = 'simple go program demo'
         elif command[0] == "tsdebug":
-            print_pos(tree_search(tree, N_SIMS, W*W*[0], disp=True))
+            print_pos(tree.child(tree_search(tree, N_SIMS, W*W*[0], disp=True)).pos)
         elif command[0] == "list_commands":
             ret = '\n'.join(known_commands)
         elif command[0] == "known_command":
@@ -1153,13 +3105,18 @@ def gtp_io():
 
 
 if __name__ == "__main__":
-    try:
+    if sys.argv[1:2] == ['compile_patterns']:
         with open(spat_patterndict_file) as f:
-            print('Loading pattern spatial dictionary...', file=sys.stderr)
             load_spat_patterndict(f)
         with open(large_patterns_file) as f:
-            print('Loading large patterns...', file=sys.stderr)
             load_large_patterns(f)
+        index_large_patterns()
+        with open(patterns_db_file, 'wb') as f:
+            compile_patterns(f)
+        print('Compiled %d patterns to %s' % (len(pattern_probs), patterns_db_file), file=sys.stderr)
+        sys.exit(0)
+    try:
+        load_patterns()
         print('Done.', file=sys.stderr)
     except IOError as e:
         print('Warning: Cannot load pattern files: %s; will be much weaker, consider lowering EXPAND_VISITS 5->2' % (e,), file=sys.stderr)
@@ -1169,18 +3126,34 @@ if __name__ == "__main__":
     elif sys.argv[1] == "white":
         game_io(computer_black=True)
     elif sys.argv[1] == "gtp":
-        gtp_io()
+        # optional arguments: ponder, profile, book
+        if PROFILE or 'profile' in sys.argv[2:]:
+            set_profiling(dict(PROFILE_PHASES))
+        if BOOK or 'book' in sys.argv[2:]:
+            open_book()
+        gtp_io(ponder=PONDER or 'ponder' in sys.argv[2:])
     elif sys.argv[1] == "mcdebug":
         print(mcplayout(empty_position(), W*W*[0], disp=True)[0])
     elif sys.argv[1] == "mcbenchmark":
         print(mcbenchmark(20))
+    elif sys.argv[1] == "benchmark":
+        # optional argument: file with the JSON output of an earlier run to compare with
+        baseline = None
+        if len(sys.argv) > 2:
+            with open(sys.argv[2]) as f:
+                baseline = json.load(f)
+        print(json.dumps(benchmark(baseline), indent=2, sort_keys=True))
     elif sys.argv[1] == "tsbenchmark":
+        # optional argument: number of playouts per worker batch, for tuning
+        batch = int(sys.argv[2]) if len(sys.argv) > 2 else PLAYOUT_BATCH
         t_start = time.time()
-        print_pos(tree_search(TreeNode(pos=empty_position()), N_SIMS, W*W*[0], disp=False).pos)
+        tree = TreeNode(pos=empty_position())
+        print_pos(tree.child(tree_search(tree, N_SIMS, W*W*[0], disp=False, batch=batch)).pos)
         print('Tree search with %d playouts took %.3fs with %d threads; speed is %.3f playouts/thread/s' %
               (N_SIMS, time.time() - t_start, multiprocessing.cpu_count(),
                N_SIMS / ((time.time() - t_start) * multiprocessing.cpu_count())))
     elif sys.argv[1] == "tsdebug":
-        print_pos(tree_search(TreeNode(pos=empty_position()), N_SIMS, W*W*[0], disp=True).pos)
+        tree = TreeNode(pos=empty_position())
+        print_pos(tree.child(tree_search(tree, N_SIMS, W*W*[0], disp=True)).pos)
     else:
         print('Unknown action', file=sys.stderr)